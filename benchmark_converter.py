@@ -0,0 +1,393 @@
+"""Benchmarks for convert_iterm2_to_vim.py.
+
+Usage:
+    python benchmark_converter.py [run] [--output results.json] [--quick]
+    python benchmark_converter.py diff <old.json> <new.json> [--threshold PERCENT]
+    python benchmark_converter.py lut [--bits BITS]
+    python benchmark_converter.py startup [--script PATH]...
+
+`run` times every stage of a conversion separately (parsing, color
+conversion, derived colors and rendering) and records the best wall time and
+peak traced memory of each. Save results of two commits with --output and
+compare them with `diff`, which exits with status 1 when a benchmark got
+slower or hungrier than the threshold allows.
+
+`startup` times fresh converter processes, which is what a theme build pays
+for every file. Pass --script several times, e.g. with a copy of the script
+from an older commit, to compare them.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from convert_iterm2_to_vim import (
+    DEFAULT_THEME_PATH, DERIVED_COLOR_PLAN, ITERM_TO_VIM_MAP, LUT_BITS, RENDERERS, convert_color, convert_colors,
+    derive_colors, generate_vim_colorscheme, load_lut, parse_iterm_colors,
+)
+
+# Batch sizes used by the conversion benchmarks
+COLOR_COUNTS = [1, 1_000, 1_000_000]
+
+# Calling convert_color() once per color is too slow for the biggest batches
+SINGLE_COLOR_COUNTS = [1, 1_000]
+
+# Number of top-level keys in the synthetic iTerm2 colors files
+PLIST_KEY_COUNTS = [100, 1_000, 10_000, 100_000]
+
+# Smaller sizes for quick runs, e.g. on every CI build
+QUICK_COLOR_COUNTS = [1, 1_000]
+QUICK_PLIST_KEY_COUNTS = [100, 1_000]
+
+# Converter script timed by the startup benchmark
+CONVERTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_iterm2_to_vim.py')
+
+# Real theme used for the parse, derive and render benchmarks
+THEME_PATH = DEFAULT_THEME_PATH
+THEME_NAME = 'Squirrelsong Dark'
+
+# Bump when the results file format changes
+RESULTS_FORMAT_VERSION = 1
+
+# Percent change a diff tolerates before reporting a regression
+DEFAULT_THRESHOLD = 10
+
+def time_call(func, repeat=5, budget=None):
+    """Run a function several times and return the best wall time in seconds.
+
+    With a budget (in seconds), stop repeating once the runs took that long.
+    """
+    best = float('inf')
+    total = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        if budget is not None and total >= budget:
+            break
+    return best
+
+def measure_peak_memory(func):
+    """Run a function once and return the peak memory it allocated in bytes, as seen by tracemalloc."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def format_time(seconds):
+    """Format a duration with a unit that keeps the number readable."""
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f} µs'
+    if seconds < 1:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds:.2f} s'
+
+def format_bytes(size):
+    """Format a byte count with a unit that keeps the number readable."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+def make_synthetic_plist(key_count, seed=0):
+    """Build an iTerm2 colors file with key_count colors as bytes.
+
+    The file holds every color the converter knows followed by random filler
+    colors, so parsing it produces a full palette while scanning all the keys.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(ITERM_TO_VIM_MAP)[:key_count]
+    names += [f'Synthetic {i} Color' for i in range(key_count - len(names))]
+    components = rng.random((key_count, 3)).tolist()
+
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<plist version="1.0">\n<dict>\n']
+    for name, (r, g, b) in zip(names, components):
+        parts.append(f'\t<key>{name}</key>\n\t<dict>\n'
+                     f'\t\t<key>Alpha Component</key>\n\t\t<real>1</real>\n'
+                     f'\t\t<key>Blue Component</key>\n\t\t<real>{b!r}</real>\n'
+                     f'\t\t<key>Color Space</key>\n\t\t<string>P3</string>\n'
+                     f'\t\t<key>Green Component</key>\n\t\t<real>{g!r}</real>\n'
+                     f'\t\t<key>Red Component</key>\n\t\t<real>{r!r}</real>\n'
+                     f'\t</dict>\n')
+    parts.append('</dict>\n</plist>\n')
+    return ''.join(parts).encode()
+
+def iter_benchmarks(quick=False):
+    """Yield (name, size, function) for every stage benchmark.
+
+    Size is the number of colors or plist keys the function processes.
+    """
+    color_counts = QUICK_COLOR_COUNTS if quick else COLOR_COUNTS
+    single_color_counts = [count for count in SINGLE_COLOR_COUNTS if count in color_counts]
+    key_counts = QUICK_PLIST_KEY_COUNTS if quick else PLIST_KEY_COUNTS
+
+    # Parsing
+    with open(THEME_PATH, 'rb') as f:
+        theme_bytes = f.read()
+    yield 'parse/theme', len(ITERM_TO_VIM_MAP), lambda: parse_iterm_colors(io.BytesIO(theme_bytes))
+    for key_count in key_counts:
+        plist = make_synthetic_plist(key_count)
+        yield 'parse/synthetic', key_count, lambda plist=plist: parse_iterm_colors(io.BytesIO(plist))
+        yield 'parse/synthetic-stream', key_count, \
+            lambda plist=plist: parse_iterm_colors(io.BytesIO(plist), stream=True)
+
+    # P3 to sRGB conversion, palette colors are stored with 8 bits per channel
+    rng = np.random.default_rng(0)
+    for count in color_counts:
+        colors = rng.integers(0, 256, (count, 3)).astype(np.float64) / 255
+        yield 'convert/batch', count, lambda colors=colors: convert_colors(colors, dtype=np.float64)
+        if count in single_color_counts:
+            rows = [tuple(color) for color in colors]
+            yield 'convert/single', count, lambda rows=rows: [convert_color(row) for row in rows]
+
+    # Derived colors, from the base colors of the real theme
+    palette = parse_iterm_colors(THEME_PATH)
+    base_colors = {name: palette[name] for name in ITERM_TO_VIM_MAP.values() if name in palette}
+    yield 'derive', len(DERIVED_COLOR_PLAN['order']), lambda: derive_colors(base_colors)
+
+    # Rendering
+    yield 'render/vim', len(palette), lambda: generate_vim_colorscheme(palette, THEME_NAME)
+    for target, (_, _, render) in RENDERERS.items():
+        if target != 'vim':
+            yield f'render/{target}', len(palette), lambda render=render: join_chunks(render(palette, THEME_NAME))
+
+def join_chunks(chunks):
+    """Join rendered chunks, which are bytes for binary targets and strings for the others."""
+    chunks = list(chunks)
+    return b''.join(chunks) if chunks and isinstance(chunks[0], bytes) else ''.join(chunks)
+
+def get_git_commit():
+    """Return the current git commit of the repository, or None outside a git checkout."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+def run_benchmarks(quick=False, repeat=5, budget=2.0):
+    """Run every stage benchmark, printing a table, and return the results.
+
+    Returns:
+        Dict with the environment and a list of results with name, size, best
+        time in seconds and peak memory in bytes
+    """
+    results = []
+    print(f'{"benchmark":<26}  {"size":>8}  {"time":>12}  {"peak memory":>12}')
+    for name, size, func in iter_benchmarks(quick):
+        # Warm up caches and lazily built tables, then time without tracing
+        func()
+        best = time_call(func, repeat, budget)
+        peak = measure_peak_memory(func)
+        results.append({'name': name, 'size': size, 'time': best, 'peak_memory': peak})
+        print(f'{name:<26}  {size:>8}  {format_time(best):>12}  {format_bytes(peak):>12}')
+
+    return {
+        'version': RESULTS_FORMAT_VERSION,
+        'commit': get_git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+    }
+
+def load_results(path):
+    """Load a benchmark results file, keyed by (name, size)."""
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != RESULTS_FORMAT_VERSION:
+        raise ValueError(f"Unsupported benchmark results format in '{path}'")
+    return data, {(result['name'], result['size']): result for result in data['results']}
+
+def diff_results(old, new, threshold=DEFAULT_THRESHOLD):
+    """Compare two sets of benchmark results.
+
+    Args:
+        old: Dict of (name, size) to result, see load_results()
+        new: Dict of (name, size) to result
+        threshold: Percent increase of time or peak memory that counts as a regression
+
+    Returns:
+        List of (name, size, metric, old value, new value, percent change,
+        regression) tuples for benchmarks present in both sets
+    """
+    changes = []
+    for key, new_result in new.items():
+        if key not in old:
+            continue
+        for metric in ('time', 'peak_memory'):
+            old_value, new_value = old[key][metric], new_result[metric]
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            changes.append((*key, metric, old_value, new_value, change, change > threshold))
+    return changes
+
+def print_diff(old_path, new_path, threshold=DEFAULT_THRESHOLD):
+    """Print a comparison of two results files and return the number of regressions."""
+    old_data, old = load_results(old_path)
+    new_data, new = load_results(new_path)
+    print(f'old: {old_path} ({(old_data.get("commit") or "unknown")[:10]})')
+    print(f'new: {new_path} ({(new_data.get("commit") or "unknown")[:10]})\n')
+
+    formatters = {'time': format_time, 'peak_memory': format_bytes}
+    print(f'{"benchmark":<26}  {"size":>8}  {"metric":<11}  {"old":>12}  {"new":>12}  {"change":>8}')
+    regressions = 0
+    for name, size, metric, old_value, new_value, change, regression in diff_results(old, new, threshold):
+        formatter = formatters[metric]
+        marker = '  REGRESSION' if regression else ''
+        print(f'{name:<26}  {size:>8}  {metric:<11}  {formatter(old_value):>12}  '
+              f'{formatter(new_value):>12}  {change:>+7.1f}%{marker}')
+        regressions += regression
+
+    for name, size in sorted(old.keys() - new.keys()):
+        print(f'{name:<26}  {size:>8}  only in old results')
+    for name, size in sorted(new.keys() - old.keys()):
+        print(f'{name:<26}  {size:>8}  only in new results')
+
+    print(f'\n{regressions} regression(s) above {threshold}%')
+    return regressions
+
+def benchmark_lut(direction='p3_to_srgb', bits=8):
+    """Compare lookup table conversion with direct matrix conversion."""
+    # Building (or opening) the table is a one-time cost, keep it out of the timings
+    start = time.perf_counter()
+    load_lut(direction, bits)
+    print(f'LUT {bits}-bit {direction} ready in {format_time(time.perf_counter() - start)}\n')
+
+    rng = np.random.default_rng(0)
+    print(f'{"colors":>10}  {"direct":>12}  {"LUT":>12}  {"speedup":>8}  {"max diff":>8}')
+    for count in COLOR_COUNTS:
+        # Palette colors are stored with 8 bits per channel
+        colors = rng.integers(0, 256, (count, 3)).astype(np.float32) / 255
+        direct_time = time_call(lambda: convert_colors(colors, direction))
+        lut_time = time_call(lambda: convert_colors(colors, direction, lut_bits=bits))
+
+        # Largest difference in output steps of the table's bit depth
+        max_value = 2 ** bits - 1
+        direct = convert_colors(colors, direction)
+        looked_up = convert_colors(colors, direction, lut_bits=bits)
+        max_diff = np.abs(direct - looked_up).max() * max_value
+
+        print(f'{count:>10}  {format_time(direct_time):>12}  {format_time(lut_time):>12}  '
+              f'{direct_time / lut_time:>7.1f}x  {max_diff:>8.2f}')
+
+def time_process(command, repeat=10, cwd=None):
+    """Run a command several times and return the wall times in seconds.
+
+    Returns:
+        Tuple of (list of times, exit code), stopping at the first run that fails
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode:
+            return times, result.returncode
+        times.append(time.perf_counter() - start)
+    return times, 0
+
+def benchmark_startup(scripts=None, repeat=10):
+    """Time `--help` and a single-file conversion in fresh processes for each converter script.
+
+    Older scripts may not have `--help` or `--no-cache`: conversions fall back to
+    a plain `script theme output` run, and commands that still fail are
+    reported with their exit code instead of times.
+    """
+    scripts = [os.path.abspath(script) for script in scripts or [CONVERTER_PATH]]
+    output_dir = tempfile.mkdtemp()
+    output_path = os.path.join(output_dir, 'theme.vim')
+    try:
+        print(f'{"script":<40}  {"command":<12}  {"best":>10}  {"median":>10}')
+        for script in scripts:
+            commands = [
+                ('--help', [[sys.executable, script, '--help']]),
+                # Skip the build cache so every run converts
+                ('convert', [[sys.executable, script, THEME_PATH, output_path, '--no-cache'],
+                             [sys.executable, script, THEME_PATH, output_path]]),
+            ]
+            for name, alternatives in commands:
+                for command in alternatives:
+                    times, exit_code = time_process(command, repeat, cwd=output_dir)
+                    if not exit_code:
+                        break
+                if exit_code:
+                    print(f'{script[-40:]:<40}  {name:<12}  {f"failed with exit code {exit_code}":>22}')
+                else:
+                    print(f'{script[-40:]:<40}  {name:<12}  {format_time(min(times)):>10}  '
+                          f'{format_time(statistics.median(times)):>10}')
+    finally:
+        shutil.rmtree(output_dir)
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the iTerm2 to Vim colorscheme converter.")
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help="time every conversion stage (default)")
+    run_parser.add_argument('-o', '--output', help="save results to a JSON file")
+    run_parser.add_argument('--quick', action='store_true', help="skip the biggest inputs")
+    run_parser.add_argument('--repeat', type=int, default=5,
+                            help="number of timed runs per benchmark (default: 5)")
+
+    diff_parser = commands.add_parser('diff', help="compare two results files")
+    diff_parser.add_argument('old', help="baseline results file")
+    diff_parser.add_argument('new', help="results file to check")
+    diff_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                             help=f"percent slowdown reported as a regression (default: {DEFAULT_THRESHOLD})")
+
+    lut_parser = commands.add_parser('lut', help="compare lookup table and direct conversion")
+    lut_parser.add_argument('--bits', type=int, choices=LUT_BITS, default=8,
+                            help="lookup table bit depth (default: 8)")
+
+    startup_parser = commands.add_parser('startup', help="time converter runs in fresh processes")
+    startup_parser.add_argument('--script', dest='scripts', action='append', metavar='PATH',
+                                help="converter script to time, can be repeated (default: this checkout)")
+    startup_parser.add_argument('--repeat', type=int, default=10,
+                                help="number of runs per command (default: 10)")
+
+    # Run is the default command
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in (*commands.choices, '-h', '--help'):
+        argv.insert(0, 'run')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'diff':
+        sys.exit(1 if print_diff(args.old, args.new, args.threshold) else 0)
+
+    if args.command == 'lut':
+        benchmark_lut(bits=args.bits)
+        return
+
+    if args.command == 'startup':
+        benchmark_startup(args.scripts, args.repeat)
+        return
+
+    data = run_benchmarks(args.quick, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.write('\n')
+        print(f"\nResults saved to '{args.output}'")
+
+if __name__ == "__main__":
+    main()
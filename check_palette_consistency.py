@@ -0,0 +1,259 @@
+"""Check that theme files under themes/ use the colors of the iTerm2 palette.
+
+Usage: python check_palette_consistency.py [paths...] [--palette FILE] [--threshold DELTA] [--baseline FILE]
+                                          [--update-baseline] [--json FILE]
+
+The palette is the base colors of the iTerm2 theme from parse_base_colors(),
+without the derived and semantic colors the Vim colorschemes add. By default
+only the dark theme files are scanned, since the palette is the dark one.
+Every theme file is memory-mapped and scanned for hex colors in a process
+pool, building an index of colors to the files and lines that use them.
+Colors that aren't in the palette but are perceptually very close to a
+palette color are reported as drift: usually a color that was tweaked in one
+theme and not the others, or converted with different rounding.
+
+Known drift is listed in a baseline file of colors to the palette colors they
+drift from, and isn't reported again; --update-baseline records the current
+drift. Exits with status 1 when anything new drifted, so it can run as a
+pre-commit hook.
+"""
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from convert_iterm2_to_vim import (
+    DEFAULT_THEME_PATH,
+    find_iterm_colors_files,
+    parse_base_colors,
+    srgb_to_oklab_color,
+)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Directory scanned by default
+THEMES_DIR = os.path.join(ROOT, 'themes')
+
+# Only files with this in their path under themes/ are scanned by default
+DEFAULT_VARIANT = 'dark'
+
+# Drift that is known and accepted
+BASELINE_PATH = os.path.join(ROOT, 'palette_baseline.json')
+
+# Files that can't contain readable hex colors
+BINARY_EXTENSIONS = {'.gif', '.ico', '.jpeg', '.jpg', '.png', '.webp', '.zip'}
+
+# Hex colors with 3, 6 or 8 (with alpha) digits
+HEX_COLOR_PATTERN = re.compile(rb'#([0-9a-fA-F]{8}|[0-9a-fA-F]{6}|[0-9a-fA-F]{3})\b')
+
+# Largest OKLab distance from a palette color that counts as drift. Around
+# 0.02 is the smallest difference people notice, anything further away is
+# taken as a different color on purpose.
+DEFAULT_THRESHOLD = 0.02
+
+def normalize_hex_color(digits):
+    """Return '#rrggbb' for the digits of a 3, 6 or 8 digit hex color, ignoring alpha."""
+    digits = digits.decode('ascii').lower()
+    if len(digits) == 3:
+        digits = ''.join(digit * 2 for digit in digits)
+    return '#' + digits[:6]
+
+def find_theme_files(paths, variant=None):
+    """Expand files and directories into a sorted list of files that can hold hex colors.
+
+    Args:
+        paths: Files and directories
+        variant: Only keep files in directories with this in their path below
+            the given one, or with it in their name, case-insensitively
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.update(os.path.join(directory, name) for name in names
+                             if variant is None
+                             or variant in os.path.relpath(os.path.join(directory, name), path).lower())
+        elif os.path.isfile(path):
+            files.add(path)
+    return sorted(path for path in files if os.path.splitext(path)[1].lower() not in BINARY_EXTENSIONS)
+
+def scan_file(path):
+    """Return (path, list of (hex color, line number)) of every hex color in a file."""
+    colors = []
+    with open(path, 'rb') as f:
+        # Empty files can't be mapped, and have no colors anyway
+        if os.fstat(f.fileno()).st_size == 0:
+            return path, colors
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            line = 1
+            position = 0
+            for match in HEX_COLOR_PATTERN.finditer(data):
+                line += data[position:match.start()].count(b'\n')
+                position = match.start()
+                colors.append((normalize_hex_color(match.group(1)), line))
+    return path, colors
+
+def build_color_index(paths, jobs=None, variant=None):
+    """Scan theme files for hex colors in a process pool, see find_theme_files().
+
+    Returns:
+        Dict of '#rrggbb' colors to lists of (path, line number), sorted by color
+    """
+    files = find_theme_files(paths, variant)
+    if jobs == 1 or len(files) <= 1:
+        results = [scan_file(path) for path in files]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Files are small, hand them out in batches to keep the overhead down
+            chunksize = max(1, len(files) // ((jobs or os.cpu_count() or 1) * 4))
+            results = list(executor.map(scan_file, files, chunksize=chunksize))
+
+    index = {}
+    for path, colors in results:
+        for color, line in colors:
+            index.setdefault(color, []).append((path, line))
+    return dict(sorted(index.items()))
+
+def load_palette(palette_paths):
+    """Return a dict of '#rrggbb' base colors to the names they have in the iTerm2 palettes."""
+    palette = {}
+    for path in find_iterm_colors_files(palette_paths):
+        for name, value in parse_base_colors(path).items():
+            palette.setdefault(value, []).append(name)
+    return palette
+
+def load_baseline(path):
+    """Return a dict of known drifted '#rrggbb' colors to the palette colors they drift from.
+
+    A missing baseline file counts as an empty one.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_baseline(path, drift):
+    """Save drift as the baseline, see load_baseline()."""
+    with open(path, 'w') as f:
+        json.dump({color: nearest for color, nearest, _, _ in sorted(drift)}, f, indent=2)
+        f.write('\n')
+
+def oklab_distance(a, b):
+    """Return the Euclidean distance between two OKLab colors."""
+    return sum((x - y) ** 2 for x, y in zip(a, b)) ** 0.5
+
+def find_drift(index, palette, threshold=DEFAULT_THRESHOLD, baseline=None):
+    """Find colors that aren't in the palette but are within the threshold of a palette color.
+
+    Colors the baseline lists with the same nearest palette color are left out,
+    so known drift is reported again once the palette color changes.
+
+    Returns:
+        List of (color, nearest palette color, distance, occurrences) tuples,
+        closest first
+    """
+    def to_oklab(color):
+        return srgb_to_oklab_color(*(value / 255 for value in bytes.fromhex(color[1:])))
+
+    palette_oklab = [(color, to_oklab(color)) for color in palette]
+    drift = []
+    for color, occurrences in index.items():
+        if color in palette:
+            continue
+        oklab = to_oklab(color)
+        nearest, distance = min(((palette_color, oklab_distance(oklab, palette_value))
+                                 for palette_color, palette_value in palette_oklab),
+                                key=lambda candidate: candidate[1])
+        if distance <= threshold and (baseline or {}).get(color) != nearest:
+            drift.append((color, nearest, distance, occurrences))
+    return sorted(drift, key=lambda item: item[2])
+
+def print_report(index, palette, drift, known, elapsed):
+    """Print drifted colors with their locations and a summary.
+
+    Args:
+        index: Color index from build_color_index()
+        palette: Palette from load_palette()
+        drift: New drift from find_drift()
+        known: Number of drifted colors in the baseline
+        elapsed: Time taken, in seconds
+    """
+    for color, nearest, distance, occurrences in drift:
+        print(f"{color} is {distance:.4f} from {nearest} ({', '.join(palette[nearest])})")
+        for path, line in occurrences:
+            print(f"  {os.path.relpath(path)}:{line}")
+
+    files = {path for occurrences in index.values() for path, _ in occurrences}
+    used = sum(1 for color in palette if color in index)
+    print(f"\nIndexed {len(index)} colors in {len(files)} files in {elapsed:.2f}s, "
+          f"{used} of {len(palette)} palette colors used, {len(drift)} drifted, {known} known")
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Check that theme files use the colors of the iTerm2 palette.")
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help="files or directories to scan (default: the dark theme files in themes/)")
+    parser.add_argument('--palette', action='append', metavar='FILE',
+                        help="iTerm2 colors file, directory or glob to take the palette from, can be repeated "
+                             "(default: the Squirrelsong Dark iTerm2 theme)")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"largest OKLab distance reported as drift (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument('--baseline', default=BASELINE_PATH, metavar='FILE',
+                        help="JSON file of known drift to leave out (default: palette_baseline.json)")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="save all current drift to the baseline file instead of reporting it")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--json', metavar='FILE', help="save the color index and drift to a JSON file")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    start = time.perf_counter()
+    palette = load_palette(args.palette or [DEFAULT_THEME_PATH])
+    if not palette:
+        print("Error: no iTerm2 palette colors found.")
+        sys.exit(1)
+    if args.paths:
+        index = build_color_index(args.paths, args.jobs)
+    else:
+        index = build_color_index([THEMES_DIR], args.jobs, DEFAULT_VARIANT)
+
+    if args.update_baseline:
+        drift = find_drift(index, palette, args.threshold)
+        save_baseline(args.baseline, drift)
+        print(f"Saved {len(drift)} drifted colors to '{args.baseline}'")
+        return
+
+    baseline = load_baseline(args.baseline)
+    drift = find_drift(index, palette, args.threshold, baseline)
+    known = sum(1 for color, nearest in baseline.items() if color in index and nearest in palette)
+    print_report(index, palette, drift, known, time.perf_counter() - start)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'palette': palette,
+                'index': index,
+                'drift': [
+                    {'color': color, 'nearest': nearest, 'distance': distance, 'occurrences': occurrences}
+                    for color, nearest, distance, occurrences in drift
+                ],
+            }, f, indent=2)
+            f.write('\n')
+        print(f"Index saved to '{args.json}'")
+
+    if drift:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,247 @@
+import time
+
+# Taken before any other import, so --profile can report the import time
+_IMPORT_STARTED = (time.perf_counter(), time.process_time())
+
 import xml.etree.ElementTree as ET
-import numpy as np
+import argparse
+import contextlib
+import csv
+import glob
+import filecmp
+import fnmatch
+import hashlib
+import io
+import json
+import math
+import mmap
 import os
+import struct
 import sys
+import threading
+import tracemalloc
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# NumPy is imported inside the functions that need it. Converting a single
+# theme takes a few dozen colors, which pure Python handles faster than
+# importing NumPy takes, so only batch array conversions and lookup tables pay
+# for the import.
+
+# Per-stage statistics collected by --profile, None when profiling is off
+_profile_stages = None
+_profile_stack = []
+
+def start_profiling():
+    """Start collecting wall time, CPU time and tracemalloc peaks of the profiled stages."""
+    global _profile_stages
+    _profile_stages = {}
+    _profile_stack.clear()
+    # Memory isn't traced during import, only its time is known
+    wall_start, cpu_start = _IMPORT_STARTED
+    wall_end, cpu_end = _IMPORT_FINISHED
+    _profile_stages['import'] = {'calls': 1, 'wall': wall_end - wall_start, 'cpu': cpu_end - cpu_start,
+                                 'peak_memory': None}
+    tracemalloc.start()
+
+def stop_profiling():
+    """Stop profiling and return the statistics of every stage, in the order they first ran.
+
+    Returns:
+        Dict of stage names to dicts with the number of calls, wall and CPU
+        time in seconds spent in the stage itself (excluding nested stages),
+        and the peak memory in bytes the stage allocated (including nested
+        stages)
+    """
+    global _profile_stages
+    stages, _profile_stages = _profile_stages, None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return stages or {}
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """Attribute the time and memory of the enclosed code to a profiling stage.
+
+    Does nothing unless start_profiling() was called. Stages can be nested,
+    time spent in a nested stage counts only for the nested one.
+    """
+    if _profile_stages is None:
+        yield
+        return
+    
+    # tracemalloc only has a global peak, hand the peak so far to the parent before resetting it
+    current, peak = tracemalloc.get_traced_memory()
+    if _profile_stack:
+        _profile_stack[-1]['peak'] = max(_profile_stack[-1]['peak'], peak)
+    tracemalloc.reset_peak()
+    stage = _profile_stages.setdefault(name, {'calls': 0, 'wall': 0, 'cpu': 0, 'peak_memory': 0})
+    frame = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'memory': current,
+             'peak': current, 'child_wall': 0, 'child_cpu': 0}
+    _profile_stack.append(frame)
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - frame['wall']
+        cpu = time.process_time() - frame['cpu']
+        frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _profile_stack.pop()
+        if _profile_stack:
+            _profile_stack[-1]['child_wall'] += wall
+            _profile_stack[-1]['child_cpu'] += cpu
+            _profile_stack[-1]['peak'] = max(_profile_stack[-1]['peak'], frame['peak'])
+        
+        stage['calls'] += 1
+        stage['wall'] += wall - frame['child_wall']
+        stage['cpu'] += cpu - frame['child_cpu']
+        stage['peak_memory'] = max(stage['peak_memory'], frame['peak'] - frame['memory'])
+
+def profile_iter(name, iterable):
+    """Yield the items of an iterable, attributing the time to produce each one to a profiling stage."""
+    if _profile_stages is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        with profile_stage(name):
+            item = next(iterator, done)
+        if item is done:
+            return
+        yield item
 
-# Conversion matrices
-P3_TO_XYZ_MATRIX = np.array([
+def format_profile(stages):
+    """Format profiling statistics as a table."""
+    lines = [f"{'stage':<18} {'calls':>6} {'wall':>10} {'cpu':>10} {'peak memory':>12}"]
+    for name, stage in stages.items():
+        peak = '-' if stage['peak_memory'] is None else f"{stage['peak_memory'] / 1024:.1f} KiB"
+        lines.append(f"{name:<18} {stage['calls']:>6} {stage['wall'] * 1000:>7.2f} ms "
+                     f"{stage['cpu'] * 1000:>7.2f} ms {peak:>12}")
+    total_wall = sum(stage['wall'] for stage in stages.values())
+    total_cpu = sum(stage['cpu'] for stage in stages.values())
+    lines.append(f"{'total':<18} {'':>6} {total_wall * 1000:>7.2f} ms {total_cpu * 1000:>7.2f} ms")
+    return '\n'.join(lines) + '\n'
+
+def round_to_float32(value):
+    """Round a float to the nearest single precision value."""
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+def multiply_matrices(a, b):
+    """Multiply two 3x3 matrices given as nested tuples."""
+    return tuple(
+        tuple(a[i][0] * b[0][j] + a[i][1] * b[1][j] + a[i][2] * b[2][j] for j in range(3))
+        for i in range(3)
+    )
+
+def invert_matrix(m):
+    """Invert a 3x3 matrix given as nested tuples."""
+    cofactors = [
+        [m[(i + 1) % 3][(j + 1) % 3] * m[(i + 2) % 3][(j + 2) % 3]
+         - m[(i + 1) % 3][(j + 2) % 3] * m[(i + 2) % 3][(j + 1) % 3] for j in range(3)]
+        for i in range(3)
+    ]
+    determinant = sum(m[0][j] * cofactors[0][j] for j in range(3))
+    if determinant == 0:
+        raise ValueError("Matrix is singular")
+    return tuple(tuple(cofactors[j][i] / determinant for j in range(3)) for i in range(3))
+
+# Conversion matrices, stored as single precision values
+P3_TO_XYZ_MATRIX = tuple(tuple(round_to_float32(value) for value in row) for row in [
     [0.48657, 0.26567, 0.19823],
     [0.22897, 0.69171, 0.07932],
     [0.00000, 0.04573, 0.95427]
-], dtype=np.float32)
+])
 
 # XYZ to sRGB conversion matrix
-XYZ_TO_SRGB_MATRIX = np.array([
+XYZ_TO_SRGB_MATRIX = tuple(tuple(round_to_float32(value) for value in row) for row in [
     [ 3.2406255, -1.5372080, -0.4986286],
     [-0.9689307,  1.8757561,  0.0415560],
     [ 0.0557101, -0.2040211,  1.0572252]
-], dtype=np.float32)
+])
 
 # Matrix from example_srgb_p3.py
-SRGB_TO_P3_MATRIX = np.array([
+SRGB_TO_P3_MATRIX = tuple(tuple(round_to_float32(value) for value in row) for row in [
     [0.8225, 0.1774, 0],
     [0.0332, 0.9669, 0],
     [0.0171, 0.0724, 0.9108]
-], dtype=np.float32)
+])
+
+# Fused linear-light conversion matrices, computed once at import time.
+# P3 -> XYZ -> sRGB collapses into a single 3x3 product, and the inverse
+# direction no longer needs a matrix inversion on every call.
+P3_TO_SRGB_LINEAR_MATRIX = multiply_matrices(XYZ_TO_SRGB_MATRIX, P3_TO_XYZ_MATRIX)
+SRGB_TO_P3_LINEAR_MATRIX = invert_matrix(P3_TO_SRGB_LINEAR_MATRIX)
+
+LINEAR_MATRICES = {
+    'p3_to_srgb': P3_TO_SRGB_LINEAR_MATRIX,
+    'srgb_to_p3': SRGB_TO_P3_LINEAR_MATRIX,
+}
+
+# Transposed NumPy copies of the fused matrices, keyed by (direction, dtype)
+_conversion_matrices = {}
+
+def get_linear_matrix(direction):
+    """Return the fused linear-light matrix of a conversion direction."""
+    if direction not in LINEAR_MATRICES:
+        raise ValueError("Direction must be either 'p3_to_srgb' or 'srgb_to_p3'")
+    return LINEAR_MATRICES[direction]
+
+def get_conversion_matrix(direction, dtype='float32'):
+    """Return the fused matrix of a conversion direction as a transposed NumPy array.
+
+    Transposed, so batches of row vectors can be multiplied as `colors @ matrix`.
+    """
+    import numpy as np
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype must be either float32 or float64")
+    key = (direction, dtype)
+    if key not in _conversion_matrices:
+        _conversion_matrices[key] = np.array(get_linear_matrix(direction), dtype=dtype).T
+    return _conversion_matrices[key]
+
+def convert_colors(colors, direction='p3_to_srgb', dtype='float32', lut_bits=None):
+    """Convert a batch of colors between P3 and sRGB color spaces.
+
+    In float64 the results are identical to convert_color() (up to the last
+    bit of NumPy's power function), which does the same math in pure Python.
+
+    Args:
+        colors: Array-like of shape (N, 3) with values in range [0, 1]
+        direction: Either 'p3_to_srgb' or 'srgb_to_p3'
+        dtype: Floating point type used for the math, float32 or float64
+        lut_bits: If set, look colors up in a precomputed lookup table of this
+            bit depth (see LUT_BITS) instead of doing the matrix math
+
+    Returns:
+        Array of shape (N, 3) in the target color space, clipped to [0, 1]
+    """
+    import numpy as np
+    if lut_bits is not None:
+        return lut_convert_colors(colors, direction, bits=lut_bits, dtype=dtype)
+
+    matrix = get_conversion_matrix(direction, dtype)
+    rgb = np.asarray(colors, dtype=matrix.dtype)
+    if rgb.ndim != 2 or rgb.shape[1] != 3:
+        raise ValueError(f"Expected an array of shape (N, 3), got {rgb.shape}")
+
+    # Linearize, convert, then re-apply the gamma curve. The matrix product is
+    # spelled out to add the terms in the same order as convert_color().
+    encoded = gamma_encode_array(rgb)
+    linear = encoded[:, 0:1] * matrix[0] + encoded[:, 1:2] * matrix[1] + encoded[:, 2:3] * matrix[2]
+    converted = gamma_decode_array(linear)
 
-def p3_to_srgb(r, g, b):
-    """Converts P3 RGB to sRGB using NumPy."""
-    # First linearize the P3 values (remove gamma)
-    p3_linear = np.array([gamma_encode(v) for v in [r, g, b]])
-    
-    # Convert P3 to XYZ
-    xyz_color = np.dot(P3_TO_XYZ_MATRIX, p3_linear)
-    
-    # Convert XYZ to linear sRGB
-    srgb_linear = np.dot(XYZ_TO_SRGB_MATRIX, xyz_color)
-    
-    # Apply gamma correction to get sRGB
-    srgb = np.array([gamma_decode(v) for v in srgb_linear])
-    
     # Clamp values to [0,1] range
-    srgb = np.clip(srgb, 0.0, 1.0)
-    
-    return srgb
+    return np.clip(converted, 0.0, 1.0, out=converted)
+
+def p3_to_srgb(r, g, b):
+    """Converts P3 RGB to sRGB."""
+    return convert_color((r, g, b), 'p3_to_srgb')
 
 def srgb_to_p3(r, g, b):
     """Converts sRGB to P3 using proper color space transformation."""
-    # First linearize the sRGB values (remove gamma)
-    srgb_linear = np.array([gamma_encode(v) for v in [r, g, b]])
-    
-    # Convert linear sRGB to XYZ
-    xyz_color = np.dot(np.linalg.inv(XYZ_TO_SRGB_MATRIX), srgb_linear)
-    
-    # Convert XYZ to linear P3
-    p3_linear = np.dot(np.linalg.inv(P3_TO_XYZ_MATRIX), xyz_color)
-    
-    # Apply gamma correction to get P3
-    p3 = np.array([gamma_decode(v) for v in p3_linear])
-    
-    # Clamp values to [0,1] range
-    p3 = np.clip(p3, 0.0, 1.0)
-    
-    return p3
+    return convert_color((r, g, b), 'srgb_to_p3')
 
 def gamma_decode(value):
     """Applies sRGB gamma decoding."""
@@ -76,29 +257,263 @@ def gamma_encode(value):
     else:
         return ((value + 0.055) / 1.055) ** 2.4
 
+def gamma_decode_array(values):
+    """Applies sRGB gamma decoding to every element of an array."""
+    import numpy as np
+    values = np.asarray(values)
+    # Clamp the power branch input so negative values don't produce NaNs
+    # (np.where evaluates both branches)
+    curve = 1.055 * np.maximum(values, 0.0031308) ** (1 / 2.4) - 0.055
+    return np.where(values <= 0.0031308, 12.92 * values, curve).astype(values.dtype, copy=False)
+
+def gamma_encode_array(values):
+    """Applies sRGB gamma encoding (inverse of decoding) to every element of an array."""
+    import numpy as np
+    values = np.asarray(values)
+    curve = ((np.maximum(values, 0.04045) + 0.055) / 1.055) ** 2.4
+    return np.where(values <= 0.04045, values / 12.92, curve).astype(values.dtype, copy=False)
+
+# Linear sRGB to LMS and LMS to OKLab matrices
+# https://bottosson.github.io/posts/oklab/
+SRGB_TO_LMS_MATRIX = (
+    (0.4122214708, 0.5363325363, 0.0514459929),
+    (0.2119034982, 0.6806995451, 0.1073969566),
+    (0.0883024619, 0.2817188376, 0.6299787005),
+)
+LMS_TO_OKLAB_MATRIX = (
+    (0.2104542553,  0.7936177850, -0.0040720468),
+    (1.9779984951, -2.4285922050,  0.4505937099),
+    (0.0259040371,  0.7827717662, -0.8086757660),
+)
+
+def srgb_to_oklab(colors):
+    """Convert an (N, 3) array of sRGB colors (values in range [0, 1]) to OKLab."""
+    import numpy as np
+    linear = gamma_encode_array(np.asarray(colors, dtype=np.float64))
+    return np.cbrt(linear @ np.array(SRGB_TO_LMS_MATRIX).T) @ np.array(LMS_TO_OKLAB_MATRIX).T
+
+def cbrt(value):
+    """Return the real cube root of a number."""
+    if hasattr(math, 'cbrt'):
+        return math.cbrt(value)
+    return math.copysign(abs(value) ** (1 / 3), value)
+
+def srgb_to_oklab_color(r, g, b):
+    """Convert a single sRGB color (values in range [0, 1]) to an OKLab (L, a, b) tuple."""
+    linear = (gamma_encode(r), gamma_encode(g), gamma_encode(b))
+    lms = [cbrt(row[0] * linear[0] + row[1] * linear[1] + row[2] * linear[2])
+           for row in SRGB_TO_LMS_MATRIX]
+    return tuple(row[0] * lms[0] + row[1] * lms[1] + row[2] * lms[2] for row in LMS_TO_OKLAB_MATRIX)
+
+# Version of the on-disk lookup table layout, bump it to invalidate old tables
+LUT_FORMAT_VERSION = 2
+
+# Supported lookup table bit depths. A table has 2**bits entries per axis, each
+# padded to 4 16-bit channels, so an 8-bit table takes 128 MiB on disk and a
+# 10-bit one 8 GiB. A 12-bit one would take 512 GiB.
+LUT_BITS = (8, 10)
+
+# Largest value of a lookup table channel. It's 255 * 257, so truncating a
+# stored value to 8 bits gives the same code as truncating the exact value.
+LUT_MAX_VALUE = 65535
+
+# Inputs closer than this (in steps of the table's bit depth) to a table entry
+# are looked up without interpolating
+LUT_EXACT_TOLERANCE = 1e-4
+
+# Lookup tables already opened by this process, keyed by (direction, bits, cache_dir)
+_loaded_luts = {}
+
+def get_cache_dir():
+    """Return the directory for on-disk caches, creating it if needed."""
+    cache_dir = os.environ.get('SQUIRRELSONG_CACHE_DIR')
+    if not cache_dir:
+        xdg_cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        cache_dir = os.path.join(xdg_cache, 'squirrelsong')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def get_lut_hash(direction, bits):
+    """Hash everything a lookup table depends on: layout version, bit depth and matrix."""
+    digest = hashlib.sha256(f'{LUT_FORMAT_VERSION}:{direction}:{bits}'.encode())
+    digest.update(repr(get_linear_matrix(direction)).encode())
+    return digest.hexdigest()[:16]
+
+def get_lut_path(direction, bits, cache_dir=None):
+    """Return the path of the lookup table file for the given direction and bit depth."""
+    file_name = f'lut_{direction}_{bits}bit_{get_lut_hash(direction, bits)}.npy'
+    return os.path.join(cache_dir or get_cache_dir(), file_name)
+
+def build_lut(direction, bits, path):
+    """Precompute a full conversion cube and save it as a .npy file.
+
+    Each entry holds the converted (r, g, b), truncated to 16 bits (see
+    LUT_MAX_VALUE), plus a zero padding channel, so a whole entry can be
+    fetched as a single 64-bit word. The cube is filled one red slab at a
+    time through a memory map, so building it never needs more than a single
+    slab in memory.
+    """
+    import numpy as np
+    levels = 2 ** bits
+    max_value = levels - 1
+
+    # Write to a temporary file first so other processes never see a partial table
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    lut = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint16,
+                                    shape=(levels, levels, levels, 4))
+    # Same math and precision as convert_color(), so exact codes truncate the same way
+    axis = np.arange(levels, dtype=np.float64) / max_value
+    slab = np.empty((levels * levels, 3), dtype=np.float64)
+    slab[:, 1] = np.repeat(axis, levels)
+    slab[:, 2] = np.tile(axis, levels)
+    for r in range(levels):
+        slab[:, 0] = axis[r]
+        converted = convert_colors(slab, direction, dtype='float64')
+        lut[r, :, :, :3] = np.floor(converted * LUT_MAX_VALUE).astype(np.uint16).reshape(levels, levels, 3)
+    lut.flush()
+    del lut
+    os.replace(temp_path, path)
+
+def load_lut(direction='p3_to_srgb', bits=8, cache_dir=None):
+    """Return a memory-mapped conversion cube, building it first if it's missing or stale.
+
+    The cube is returned flattened to one packed word per entry, see build_lut().
+    """
+    import numpy as np
+    if bits not in LUT_BITS:
+        raise ValueError(f"LUT bit depth must be one of {LUT_BITS}")
+    if direction not in ('p3_to_srgb', 'srgb_to_p3'):
+        raise ValueError("Direction must be either 'p3_to_srgb' or 'srgb_to_p3'")
+
+    if (direction, bits, cache_dir) in _loaded_luts:
+        return _loaded_luts[(direction, bits, cache_dir)]
+
+    path = get_lut_path(direction, bits, cache_dir)
+    levels = 2 ** bits
+    lut = None
+    if os.path.exists(path):
+        try:
+            lut = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            lut = None
+        if lut is not None and (lut.shape != (levels, levels, levels, 4) or lut.dtype != np.uint16):
+            lut = None
+
+    if lut is None:
+        # Tables built for an older version or different matrices have a
+        # different hash in their name, remove them
+        pattern = os.path.join(os.path.dirname(path), f'lut_{direction}_{bits}bit_*.npy')
+        for stale_path in glob.glob(pattern):
+            if stale_path != path:
+                os.remove(stale_path)
+        build_lut(direction, bits, path)
+        lut = np.load(path, mmap_mode='r')
+
+    # A plain array view of the map skips the memmap subclass overhead on every lookup
+    packed = np.asarray(lut).reshape(-1, 4).view(np.uint64).ravel()
+    _loaded_luts[(direction, bits, cache_dir)] = packed
+    return packed
+
+def lut_convert_colors(colors, direction='p3_to_srgb', bits=8, dtype='float32', cache_dir=None):
+    """Convert a batch of colors by indexing a precomputed lookup table.
+
+    Integer input is taken as color codes of the table's bit depth and looked
+    up directly. Float input is interpolated trilinearly between the 8
+    surrounding table entries. Results are the middle of the 16-bit step the
+    converted value falls in, so to_rgb8() and to_hex() give the same codes as
+    for convert_colors() in float64 whenever the input is an exact code of the
+    table's bit depth (like the 8-bit colors of a palette with an 8-bit
+    table). Other float input is within 0.1 (8-bit table) or 0.01 (10-bit
+    table) steps of 255 for 99% of colors, and within 3.5 (8-bit) or 1
+    (10-bit) steps of 255 for saturated P3 colors whose sRGB red or blue
+    clips to 0.
+
+    Raises:
+        ValueError: If integer codes are outside [0, 2**bits - 1]
+    """
+    import numpy as np
+    max_value = 2 ** bits - 1
+
+    rgb = np.asarray(colors)
+    if rgb.ndim != 2 or rgb.shape[1] != 3:
+        raise ValueError(f"Expected an array of shape (N, 3), got {rgb.shape}")
+    if np.issubdtype(rgb.dtype, np.integer) and rgb.size and (rgb.min() < 0 or rgb.max() > max_value):
+        raise ValueError(f"Integer color codes must be in range [0, {max_value}] for {bits}-bit tables")
+    lut = load_lut(direction, bits, cache_dir)
+
+    def look_up(indices):
+        # Flat index into the cube: (r * levels + g) * levels + b
+        flat = (indices[:, 0] << (2 * bits)) | (indices[:, 1] << bits) | indices[:, 2]
+        return lut.take(flat).view(np.uint16).reshape(-1, 4)[:, :3]
+
+    if np.issubdtype(rgb.dtype, np.integer):
+        converted = look_up(rgb.astype(np.intp)).astype(np.float64)
+    else:
+        position = np.clip(rgb.astype(np.float64), 0.0, 1.0) * max_value
+        nearest = np.rint(position)
+        # Codes divided by max_value (even in float32) land on a table entry
+        # and don't need interpolating
+        exact = (np.abs(position - nearest) < LUT_EXACT_TOLERANCE).all(axis=1)
+        if exact.all():
+            converted = look_up(nearest.astype(np.intp)).astype(np.float64)
+        else:
+            converted = np.empty(rgb.shape)
+            converted[exact] = look_up(nearest[exact].astype(np.intp))
+            
+            position = position[~exact]
+            low = np.minimum(np.floor(position), max_value - 1).astype(np.intp)
+            weight = position - low
+            weights = np.stack([1.0 - weight, weight])
+            interpolated = np.zeros(position.shape)
+            for r, g, b in np.ndindex(2, 2, 2):
+                corner_weight = weights[r, :, 0] * weights[g, :, 1] * weights[b, :, 2]
+                interpolated += corner_weight[:, None] * look_up(low + (r, g, b))
+            converted[~exact] = interpolated
+
+    converted = np.minimum((converted + 0.5) / LUT_MAX_VALUE, 1.0)
+    return converted.astype(dtype)
+
+def to_rgb8(r, g, b):
+    """Converts RGB values (0.0-1.0) to a tuple of 8-bit values."""
+    return (int(max(0, min(1, r)) * 255),
+            int(max(0, min(1, g)) * 255),
+            int(max(0, min(1, b)) * 255))
+
 def to_hex(r, g, b):
     """Converts RGB values (0.0-1.0) to hex code."""
-    return '#{:02x}{:02x}{:02x}'.format(int(max(0, min(1, r)) * 255),
-                                       int(max(0, min(1, g)) * 255),
-                                       int(max(0, min(1, b)) * 255))
+    return '#{:02x}{:02x}{:02x}'.format(*to_rgb8(r, g, b))
+
+def hex_to_rgb(value):
+    """Converts a '#rrggbb' hex code to a tuple of 8-bit values, or None for anything else (like NONE).
+
+    Raises:
+        ValueError: If the value starts with '#' but isn't a 6 digit hex code
+    """
+    if not isinstance(value, str) or not value.startswith('#'):
+        return None
+    if len(value) != 7 or not all(digit in '0123456789abcdefABCDEF' for digit in value[1:]):
+        raise ValueError(f"Invalid hex color {value!r}, expected '#rrggbb'")
+    return tuple(bytes.fromhex(value[1:]))
 
-def convert_color(color, direction='p3_to_srgb'):
+def convert_color(color, direction='p3_to_srgb', lut_bits=None):
     """Convert color between P3 and sRGB color spaces.
     
     Args:
         color: Tuple of (r, g, b) with values in range [0, 1]
         direction: Either 'p3_to_srgb' or 'srgb_to_p3'
+        lut_bits: If set, use a precomputed lookup table of this bit depth
         
     Returns:
-        Tuple of (r, g, b) in the target color space
+        Tuple of (r, g, b) in the target color space, clipped to [0, 1]
     """
-    r, g, b = color
-    if direction == 'p3_to_srgb':
-        return p3_to_srgb(r, g, b)
-    elif direction == 'srgb_to_p3':
-        return srgb_to_p3(r, g, b)
-    else:
-        raise ValueError("Direction must be either 'p3_to_srgb' or 'srgb_to_p3'")
+    if lut_bits is not None:
+        return tuple(convert_colors([color], direction, dtype='float64', lut_bits=lut_bits)[0].tolist())
+    
+    # Same math as convert_colors() in float64, without the NumPy import
+    matrix = get_linear_matrix(direction)
+    encoded = [gamma_encode(value) for value in color]
+    linear = [row[0] * encoded[0] + row[1] * encoded[1] + row[2] * encoded[2] for row in matrix]
+    return tuple(max(0.0, min(1.0, gamma_decode(value))) for value in linear)
 
 def get_color_from_dict(color_dict):
     """Extract RGB color components from an iTerm2 color dictionary."""
@@ -124,180 +539,982 @@ def get_color_from_dict(color_dict):
     
     return r, g, b, is_p3
 
-def parse_iterm_colors(iterm_colors_path):
-    """Parse iTerm2 colors file and extract colors as sRGB hex values."""
-    tree = ET.parse(iterm_colors_path)
-    root = tree.getroot()
-    
-    colors = {}
-    
-    # Define the mapping between iTerm key names and our Vim palette names
-    iterm_to_vim_map = {
-        'Ansi 0 Color': 'gray0d',           # Background color equivalent
-        'Ansi 8 Color': 'gray09',           # Bright black
-        'Ansi 1 Color': 'red',              # Red
-        'Ansi 9 Color': 'red_light',        # Bright red
-        'Ansi 2 Color': 'green',            # Green
-        'Ansi 10 Color': 'green_light',     # Bright green
-        'Ansi 3 Color': 'yellow',           # Yellow
-        'Ansi 11 Color': 'yellow_light',    # Bright yellow
-        'Ansi 4 Color': 'blue',             # Blue
-        'Ansi 12 Color': 'blue_light',      # Bright blue
-        'Ansi 5 Color': 'purple',           # Magenta
-        'Ansi 13 Color': 'purple_light',    # Bright magenta
-        'Ansi 6 Color': 'teal',             # Cyan
-        'Ansi 14 Color': 'teal_light',      # Bright cyan
-        'Ansi 7 Color': 'gray05',           # White
-        'Ansi 15 Color': 'gray04',          # Bright white
-        'Background Color': 'bg',           # Background
-        'Foreground Color': 'fg',           # Foreground
-        'Cursor Color': 'cursor',           # Cursor
-        'Selection Color': 'selection',     # Selection background
-        'Bold Color': 'bold',               # Bold text
-    }
+def iter_iterm_colors(iterm_colors_path, keys=None, stream=False):
+    """Yield (key name, r, g, b, is_p3) for each color in an iTerm2 colors file.
+
+    Keys of the top-level plist dict are paired with the element that follows
+    them in a single pass. With stream=True the file is read with ET.iterparse
+    and every element is freed once it's been handled, so memory stays flat
+    for large files.
+
+    Args:
+        iterm_colors_path: Path or file object of the iTerm2 colors file
+        keys: Optional collection of key names to extract, others are skipped
+        stream: Whether to use the streaming parser
+    """
+    if not stream:
+        top_dict = ET.parse(iterm_colors_path).getroot().find('./dict')
+        if top_dict is None:
+            return
+        key_name = None
+        for elem in top_dict:
+            if elem.tag == 'key':
+                key_name = elem.text
+                continue
+            if elem.tag == 'dict' and key_name is not None and (keys is None or key_name in keys):
+                with profile_stage('color extraction'):
+                    color = get_color_from_dict(elem)
+                yield (key_name, *color)
+            key_name = None
+        return
+
+    depth = 0
+    top_dict = None
+    in_top_dict = False
+    key_name = None
+    for event, elem in ET.iterparse(iterm_colors_path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            # Only the first dict directly inside <plist> holds the colors
+            if depth == 2 and elem.tag == 'dict' and top_dict is None:
+                top_dict = elem
+                in_top_dict = True
+            continue
+
+        depth -= 1
+        if depth == 1 and elem is top_dict:
+            in_top_dict = False
+        if depth != 2 or not in_top_dict:
+            continue
+
+        # A direct child of the top-level dict has been fully parsed
+        if elem.tag == 'key':
+            key_name = elem.text
+        else:
+            if elem.tag == 'dict' and key_name is not None and (keys is None or key_name in keys):
+                with profile_stage('color extraction'):
+                    color = get_color_from_dict(elem)
+                yield (key_name, *color)
+            key_name = None
+
+        # Drop everything parsed so far, the pending key name is all we need
+        top_dict.clear()
+
+# Define the mapping between iTerm key names and our Vim palette names
+ITERM_TO_VIM_MAP = {
+    'Ansi 0 Color': 'gray0d',           # Background color equivalent
+    'Ansi 8 Color': 'gray09',           # Bright black
+    'Ansi 1 Color': 'red',              # Red
+    'Ansi 9 Color': 'red_light',        # Bright red
+    'Ansi 2 Color': 'green',            # Green
+    'Ansi 10 Color': 'green_light',     # Bright green
+    'Ansi 3 Color': 'yellow',           # Yellow
+    'Ansi 11 Color': 'yellow_light',    # Bright yellow
+    'Ansi 4 Color': 'blue',             # Blue
+    'Ansi 12 Color': 'blue_light',      # Bright blue
+    'Ansi 5 Color': 'purple',           # Magenta
+    'Ansi 13 Color': 'purple_light',    # Bright magenta
+    'Ansi 6 Color': 'teal',             # Cyan
+    'Ansi 14 Color': 'teal_light',      # Bright cyan
+    'Ansi 7 Color': 'gray05',           # White
+    'Ansi 15 Color': 'gray04',          # Bright white
+    'Background Color': 'bg',           # Background
+    'Foreground Color': 'fg',           # Foreground
+    'Cursor Color': 'cursor',           # Cursor
+    'Selection Color': 'selection',     # Selection background
+    'Bold Color': 'bold',               # Bold text
+}
+
+# Special colors we'll derive from the existing ones
+DERIVED_COLORS = {
+    'gray0e': ('bg', 0.8),              # Darker background (80% of bg)
+    'gray0f': ('bg', 0.6),              # Darkest background (60% of bg)
+    'gray0c': ('bg', 1.2),              # Slightly lighter background (120% of bg)
+    'gray0b': ('gray09', 0.8),          # Darker bright black
+    'gray0a': ('gray09', 1.2),          # Slightly lighter bright black
+    'gray07': ('fg', 0.8),              # Darker foreground
+    'gray08': ('fg', 0.6),              # Even darker foreground
+    'green_lighter': ('green_light', 1.2),
+    'green_contrast': ('green', 0.8),
+    'teal_lighter': ('teal_light', 1.2),
+    'teal_contrast': ('teal', 0.8),
+    'blue_lighter': ('blue_light', 1.2),
+    'blue_contrast': ('blue', 0.8),
+    'purple_lighter': ('purple_light', 1.2),
+    'purple_contrast': ('purple', 0.8),
+    'red_lighter': ('red_light', 1.2),
+    'red_contrast': ('red', 0.8),
+    'orange': ('yellow', 0.9),         # Slightly darker yellow
+    'orange_light': ('yellow_light', 0.9),
+    'orange_lighter': ('yellow_light', 1.1),
+    'orange_contrast': ('orange', 0.8),
+    'yellow_lighter': ('yellow_light', 1.2),
+    'yellow_contrast': ('yellow', 0.8),
+    'bright_pink': ('red_light', 1.0, 0.7, 0.8),    # Modified red with more blue
+    'bright_pink_light': ('bright_pink', 1.2),
+    'bright_pink_lighter': ('bright_pink', 1.4),
+    'bright_yellow': ('yellow_light', 1.0),
+    'bright_yellow_light': ('yellow_light', 1.2),
+    'bright_yellow_lighter': ('yellow_light', 1.4),
+    'white': ('#fdfdfe', None),
+    'none': ('NONE', None),
+}
+
+# Functional/semantic colors that map to base colors
+SEMANTIC_COLORS = {
+    'punctuation': 'fg',
+    'comment': 'gray08',
+    'keyword': 'purple',
+    'number': 'orange',
+    'property': 'blue',
+    'variable': 'blue',
+    'function': 'blue',
+    'string': 'green',
+    'type': 'teal',
+    'class': 'teal',
+    'regexp': 'red',
+    'important': 'red',
+    'url': 'blue_light',
+    'line': 'gray0b',
+}
+
+# Binary palette files start with a header of: magic, format version, number
+# of names, number of RGB rows, size of the name table and offset of the RGB
+# rows. Then come the row of every name (int32, -1 for NONE), the names
+# (UTF-8, separated by NUL bytes), and the rows (3 bytes each) at a 4-byte
+# aligned offset, so other tools can map them without reading the names.
+PALETTE_MAGIC = b'SQPL'
+PALETTE_FORMAT_VERSION = 1
+PALETTE_HEADER = struct.Struct('<4sHHIII')
+
+class Palette(Mapping):
+    """Theme colors stored as rows of a single contiguous buffer of 8-bit RGB values.
+
+    Reads like a dict of color names to '#rrggbb' hex values, or 'NONE', but
+    hex codes are only formatted when a value is read. Several names can share
+    a row, which makes semantic colors aliases that follow their base color
+    instead of copies.
+    """
+    __slots__ = ('_rows', '_rgb')
     
-    # Special colors we'll derive from the existing ones
-    derived_colors = {
-        'gray0e': ('bg', 0.8),              # Darker background (80% of bg)
-        'gray0f': ('bg', 0.6),              # Darkest background (60% of bg)
-        'gray0c': ('bg', 1.2),              # Slightly lighter background (120% of bg)
-        'gray0b': ('gray09', 0.8),          # Darker bright black
-        'gray0a': ('gray09', 1.2),          # Slightly lighter bright black
-        'gray07': ('fg', 0.8),              # Darker foreground
-        'gray08': ('fg', 0.6),              # Even darker foreground
-        'green_lighter': ('green_light', 1.2),
-        'green_contrast': ('green', 0.8),
-        'teal_lighter': ('teal_light', 1.2),
-        'teal_contrast': ('teal', 0.8),
-        'blue_lighter': ('blue_light', 1.2),
-        'blue_contrast': ('blue', 0.8),
-        'purple_lighter': ('purple_light', 1.2),
-        'purple_contrast': ('purple', 0.8),
-        'red_lighter': ('red_light', 1.2),
-        'red_contrast': ('red', 0.8),
-        'orange': ('yellow', 0.9),         # Slightly darker yellow
-        'orange_light': ('yellow_light', 0.9),
-        'orange_lighter': ('yellow_light', 1.1),
-        'orange_contrast': ('orange', 0.8),
-        'yellow_lighter': ('yellow_light', 1.2),
-        'yellow_contrast': ('yellow', 0.8),
-        'bright_pink': ('red_light', 1.0, 0.7, 0.8),    # Modified red with more blue
-        'bright_pink_light': ('bright_pink', 1.2),
-        'bright_pink_lighter': ('bright_pink', 1.4),
-        'bright_yellow': ('yellow_light', 1.0),
-        'bright_yellow_light': ('yellow_light', 1.2),
-        'bright_yellow_lighter': ('yellow_light', 1.4),
-        'white': ('#fdfdfe', None),
-        'none': ('NONE', None),
-    }
+    def __init__(self):
+        # Color names to row indices, None for NONE
+        self._rows = {}
+        # Three bytes per row
+        self._rgb = bytearray()
+    
+    @classmethod
+    def from_dict(cls, colors, aliases=None):
+        """Create a palette from a dict of color names to hex values or NONE.
+
+        Args:
+            colors: Dict of color names to hex values
+            aliases: Optional dict of color names to the names they alias,
+                like SEMANTIC_COLORS. Aliases whose value matches their target
+                share its row.
+        """
+        palette = cls()
+        for name, value in colors.items():
+            target = aliases.get(name) if aliases else None
+            if target in palette._rows and palette[target] == value:
+                palette.add_alias(name, target)
+            elif value == 'NONE':
+                palette.set_rgb(name, None)
+            else:
+                try:
+                    rgb = hex_to_rgb(value)
+                except ValueError:
+                    rgb = None
+                if rgb is None:
+                    raise ValueError(f"Color '{name}' must be a '#rrggbb' hex code or NONE, got {value!r}")
+                palette.set_rgb(name, rgb)
+        return palette
+    
+    def __getitem__(self, name):
+        row = self._rows[name]
+        if row is None:
+            return 'NONE'
+        return '#' + self._rgb[row * 3:row * 3 + 3].hex()
+    
+    def __iter__(self):
+        return iter(self._rows)
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+    
+    def row(self, name):
+        """Return the buffer row of a color, or None for NONE."""
+        return self._rows[name]
+    
+    def get_rgb(self, name):
+        """Return a color as a tuple of 8-bit values, or None if it's missing or NONE."""
+        row = self._rows.get(name)
+        if row is None:
+            return None
+        return tuple(self._rgb[row * 3:row * 3 + 3])
+    
+    def set_rgb(self, name, rgb):
+        """Set a color to a tuple of 8-bit values or None for NONE.
+
+        An existing color is updated in place, so its aliases change too.
+
+        Raises:
+            ValueError: If the color doesn't have exactly 3 values in range [0, 255]
+        """
+        row = self._rows.get(name)
+        if rgb is None:
+            self._rows[name] = None
+            return
+        rgb = bytes(rgb)
+        if len(rgb) != 3:
+            raise ValueError(f"Color '{name}' must have 3 values, got {len(rgb)}")
+        if row is None:
+            self._rows[name] = len(self._rgb) // 3
+            self._rgb.extend(rgb)
+        else:
+            self._rgb[row * 3:row * 3 + 3] = rgb
+    
+    def add_alias(self, name, target):
+        """Make a color name share the row of another color."""
+        self._rows[name] = self._rows[target]
+    
+    def copy(self):
+        """Return a copy with its own buffer."""
+        palette = type(self)()
+        palette._rows = dict(self._rows)
+        palette._rgb = bytearray(self._rgb)
+        return palette
+    
+    def to_dict(self):
+        """Return a plain dict of color names to hex values or NONE."""
+        return dict(self.items())
+    
+    def get_aliases(self):
+        """Return a dict of color names to the first color name sharing their row."""
+        targets = {}
+        aliases = {}
+        for name, row in self._rows.items():
+            if row is None:
+                continue
+            target = targets.setdefault(row, name)
+            if target != name:
+                aliases[name] = target
+        return aliases
+    
+    def to_bytes(self):
+        """Return the palette in the binary palette format, see PALETTE_HEADER."""
+        names = '\0'.join(self._rows).encode()
+        rows_offset = PALETTE_HEADER.size
+        rgb_offset = (rows_offset + 4 * len(self._rows) + len(names) + 3) // 4 * 4
+        data = bytearray(rgb_offset)
+        PALETTE_HEADER.pack_into(data, 0, PALETTE_MAGIC, PALETTE_FORMAT_VERSION, len(self._rows),
+                                 len(self._rgb) // 3, len(names), rgb_offset)
+        struct.pack_into(f'<{len(self._rows)}i', data, rows_offset,
+                         *(-1 if row is None else row for row in self._rows.values()))
+        names_offset = rows_offset + 4 * len(self._rows)
+        data[names_offset:names_offset + len(names)] = names
+        data.extend(self._rgb)
+        return bytes(data)
+    
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Load a palette from the binary palette format in bytes, a memoryview or a memory map.
+
+        Raises:
+            ValueError: If the buffer isn't a palette of this format version
+        """
+        if len(buffer) < PALETTE_HEADER.size:
+            raise ValueError("Not a palette file: too short")
+        magic, version, name_count, row_count, names_size, rgb_offset = PALETTE_HEADER.unpack_from(buffer)
+        if magic != PALETTE_MAGIC:
+            raise ValueError("Not a palette file")
+        if version != PALETTE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported palette format version {version}")
+        names_offset = PALETTE_HEADER.size + 4 * name_count
+        if names_offset + names_size > rgb_offset or rgb_offset + row_count * 3 > len(buffer):
+            raise ValueError("Palette file is truncated")
+        
+        rows = struct.unpack_from(f'<{name_count}i', buffer, PALETTE_HEADER.size)
+        names = bytes(buffer[names_offset:names_offset + names_size]).decode().split('\0') if name_count else []
+        if len(names) != name_count or any(row >= row_count for row in rows):
+            raise ValueError("Palette file is corrupted")
+        palette = cls()
+        palette._rows = {name: None if row < 0 else row for name, row in zip(names, rows)}
+        palette._rgb = bytearray(buffer[rgb_offset:rgb_offset + row_count * 3])
+        return palette
+    
+    def view(self):
+        """Return a read-only (rows, 3) memoryview of the buffer, without copying.
+
+        See row() for the rows of colors. Memoryviews can't have empty
+        dimensions, so the view of an empty palette is flat.
+        """
+        view = memoryview(self._rgb).toreadonly()
+        return view.cast('B', (len(self._rgb) // 3, 3)) if self._rgb else view
+    
+    def as_array(self):
+        """Return a read-only (rows, 3) uint8 NumPy array sharing the buffer, see row() for the rows of colors."""
+        import numpy as np
+        return np.frombuffer(memoryview(self._rgb).toreadonly(), dtype=np.uint8).reshape(-1, 3)
+
+def is_literal_color(value):
+    """Check whether a derived color base is a literal (hex code or NONE) rather than a color name."""
+    return value.startswith('#') or value == 'NONE'
+
+def compile_derived_colors(derived_colors, base_names):
+    """Compile derived color definitions into an evaluation plan.
+
+    Derived colors form a dependency graph (e.g. orange_contrast -> orange ->
+    yellow). The graph is checked for unknown bases and cycles, then sorted
+    into levels, where every color only depends on base colors or colors from
+    earlier levels. Every color gets a fixed row in the evaluation buffer, so
+    evaluating the plan doesn't need any name lookups beyond reading the base
+    colors, and a level can be evaluated as a single array operation.
+
+    Args:
+        derived_colors: Dict of derived color definitions, see DERIVED_COLORS
+        base_names: Names of the colors parsed from the iTerm2 file
+
+    Returns:
+        Dict describing the plan, to be passed to derive_colors()
+    """
+    base_names = list(dict.fromkeys(base_names))
+    literals = {}
+    bases = {}
+    factors = {}
+    for name, info in derived_colors.items():
+        base = info[0]
+        if is_literal_color(base):
+            literals[name] = base
+            continue
+        
+        if len(info) == 2:
+            # A factor of None means an exact copy of the base color
+            factor = 1.0 if info[1] is None else info[1]
+            factors[name] = (factor, factor, factor)
+        elif len(info) == 4:
+            factors[name] = tuple(info[1:4])
+        else:
+            raise ValueError(f"Derived color '{name}' must be (base, factor) or "
+                             f"(base, r_factor, g_factor, b_factor), got {info!r}")
+        
+        if base not in derived_colors and base not in base_names:
+            raise ValueError(f"Derived color '{name}' uses unknown base color '{base}'")
+        bases[name] = base
+    
+    for name, base in bases.items():
+        if literals.get(base) == 'NONE':
+            raise ValueError(f"Derived color '{name}' can't be derived from '{base}', which is NONE")
+    
+    # Depth of each derived color in the dependency graph, base colors and literals are 0
+    depths = {}
+    def get_depth(name, path):
+        if name not in bases:
+            return 0
+        if name in depths:
+            return depths[name]
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ValueError(f"Derived colors form a cycle: {' -> '.join(cycle)}")
+        depths[name] = get_depth(bases[name], path + [name]) + 1
+        return depths[name]
+    
+    for name in bases:
+        get_depth(name, [])
     
-    # Functional/semantic colors that map to base colors
-    semantic_colors = {
-        'punctuation': 'fg',
-        'comment': 'gray08',
-        'keyword': 'purple',
-        'number': 'orange',
-        'property': 'blue',
-        'variable': 'blue',
-        'function': 'blue',
-        'string': 'green',
-        'type': 'teal',
-        'class': 'teal',
-        'regexp': 'red',
-        'important': 'red',
-        'url': 'blue_light',
-        'line': 'gray0b',
+    # Rows of the evaluation buffer: base colors, hex literals, then derived colors
+    hex_literals = [name for name, value in literals.items() if value.startswith('#')]
+    slots = {name: i for i, name in enumerate(base_names + hex_literals + list(bases))}
+    
+    levels = []
+    for depth in range(1, max(depths.values(), default=0) + 1):
+        names = [name for name in bases if depths[name] == depth]
+        levels.append((
+            [slots[bases[name]] for name in names],
+            [slots[name] for name in names],
+            [factors[name] for name in names],
+        ))
+    
+    return {
+        'order': list(derived_colors),
+        'base_slots': [(name, slots[name]) for name in base_names],
+        'literal_slots': [slots[name] for name in hex_literals],
+        'literal_rgb': [tuple(bytes.fromhex(literals[name][1:])) for name in hex_literals],
+        'literals': literals,
+        'slots': slots,
+        'names': list(slots),
+        'levels': levels,
     }
+
+def scale_color(rgb, factors):
+    """Scale an 8-bit (r, g, b) tuple by per-channel factors, clamping and truncating to 8 bits."""
+    return tuple(int(min(255.0, max(0.0, value * factor))) for value, factor in zip(rgb, factors))
+
+def iter_derived_rgb(colors, plan=None):
+    """Yield (name, 8-bit RGB tuple or None for NONE) of derived colors, in definition order.
+
+    Derived colors whose base is missing from the colors are skipped.
+
+    Args:
+        colors: Palette or dict of color names to hex values
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+    """
+    plan = plan or DERIVED_COLOR_PLAN
+    slots = plan['slots']
+    # Rows of the evaluation buffer, None for colors whose base is missing
+    rgb = [None] * len(slots)
     
-    # Parse all colors from the iTerm file
-    for key_elem in root.findall('./dict/key'):
-        key_name = key_elem.text
-        if key_name in iterm_to_vim_map:
-            vim_name = iterm_to_vim_map[key_name]
-            
-            # Find the corresponding dict element (sibling of the key)
-            parent = root.find('./dict')
-            for i, elem in enumerate(parent):
-                if elem is key_elem and i+1 < len(parent) and parent[i+1].tag == 'dict':
-                    color_dict = parent[i+1]
-                    break
-            else:
-                continue  # Color dict not found, skip this key
-            
-            # Get the color components and P3 flag
-            r, g, b, is_p3 = get_color_from_dict(color_dict)
-            
-            # Convert P3 to sRGB if needed
-            if is_p3:
-                srgb = convert_color((r, g, b), 'p3_to_srgb')
-                hex_color = to_hex(*srgb)
-            else:
-                hex_color = to_hex(r, g, b)
-            
-            colors[vim_name] = hex_color
+    if isinstance(colors, Palette):
+        get_rgb = colors.get_rgb
+    else:
+        get_rgb = lambda name: hex_to_rgb(colors.get(name))
+    for name, slot in plan['base_slots']:
+        rgb[slot] = get_rgb(name)
+    for slot, literal_rgb in zip(plan['literal_slots'], plan['literal_rgb']):
+        rgb[slot] = literal_rgb
     
-    # Calculate derived colors
-    for derived_name, derived_info in derived_colors.items():
-        if derived_info[0] in colors:
-            base_color = derived_info[0]
-            
-            # Handle special case for literal hex values or NONE
-            if base_color.startswith('#') or base_color == 'NONE':
-                colors[derived_name] = base_color
+    # Scale colors level by level
+    for sources, targets, factors in plan['levels']:
+        for source, target, factor in zip(sources, targets, factors):
+            if rgb[source] is not None:
+                rgb[target] = scale_color(rgb[source], factor)
+    
+    for name in plan['order']:
+        if name in plan['literals'] and not plan['literals'][name].startswith('#'):
+            yield name, None
+        elif rgb[slots[name]] is not None:
+            yield name, rgb[slots[name]]
+
+def derive_colors(colors, plan=None):
+    """Calculate derived colors from a dict of hex colors.
+
+    Derived colors whose base is missing from the colors are skipped.
+
+    Args:
+        colors: Palette or dict of color names to hex values
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+
+    Returns:
+        Dict of derived color names to hex values (or NONE), in definition order
+    """
+    return {name: 'NONE' if rgb is None else '#' + bytes(rgb).hex()
+            for name, rgb in iter_derived_rgb(colors, plan)}
+
+# Evaluation plan for DERIVED_COLORS, compiled once at import time
+DERIVED_COLOR_PLAN = compile_derived_colors(DERIVED_COLORS, ITERM_TO_VIM_MAP.values())
+
+def update_derived_colors(colors, changed, plan=None):
+    """Recalculate the derived colors affected by changed colors, in place.
+
+    Only colors downstream of a changed color in the dependency graph are
+    recalculated, and propagation stops at colors that come out the same.
+
+    Args:
+        colors: Palette from parse_iterm_colors(), already holding the new
+            values of the changed colors, updated in place
+        changed: Names of the changed colors
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+
+    Returns:
+        Set of names of derived colors that changed
+    """
+    plan = plan or DERIVED_COLOR_PLAN
+    names = plan['names']
+    dirty = {plan['slots'][name] for name in changed if name in plan['slots']}
+    derived_changed = set()
+    for sources, targets, factors in plan['levels']:
+        for source, target, factor in zip(sources, targets, factors):
+            if source not in dirty:
                 continue
-                
-            # Simple scaling factor
-            if len(derived_info) == 2:
-                if derived_info[1] is None:  # Special case for fixed values like 'white'
-                    colors[derived_name] = base_color
-                else:
-                    factor = derived_info[1]
-                    r_hex = colors[base_color][1:3]
-                    g_hex = colors[base_color][3:5]
-                    b_hex = colors[base_color][5:7]
-                    
-                    r = int(r_hex, 16) * factor
-                    g = int(g_hex, 16) * factor
-                    b = int(b_hex, 16) * factor
-                    
-                    # Ensure values are in valid range
-                    r = max(0, min(255, r))
-                    g = max(0, min(255, g))
-                    b = max(0, min(255, b))
-                    
-                    colors[derived_name] = f'#{int(r):02x}{int(g):02x}{int(b):02x}'
-            # Custom RGB modifications
-            elif len(derived_info) == 4:
-                r_factor, g_factor, b_factor = derived_info[1:4]
-                r_hex = colors[base_color][1:3]
-                g_hex = colors[base_color][3:5]
-                b_hex = colors[base_color][5:7]
-                
-                r = int(r_hex, 16) * r_factor
-                g = int(g_hex, 16) * g_factor
-                b = int(b_hex, 16) * b_factor
-                
-                # Ensure values are in valid range
-                r = max(0, min(255, r))
-                g = max(0, min(255, g))
-                b = max(0, min(255, b))
-                
-                colors[derived_name] = f'#{int(r):02x}{int(g):02x}{int(b):02x}'
-    
-    # Add semantic colors
-    for semantic_name, base_color in semantic_colors.items():
-        if base_color in colors:
-            colors[semantic_name] = colors[base_color]
+            name = names[target]
+            rgb = scale_color(colors.get_rgb(names[source]), factor)
+            if colors.get_rgb(name) != rgb:
+                colors.set_rgb(name, rgb)
+                dirty.add(target)
+                derived_changed.add(name)
+    return derived_changed
+
+def update_palette(colors, base_colors, plan=None):
+    """Update a palette with newly parsed base colors, recalculating only what changed.
+
+    Args:
+        colors: Palette from parse_iterm_colors()
+        base_colors: Palette from parse_base_colors()
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+
+    Returns:
+        Tuple of (new palette, set of names of changed colors)
+    """
+    base_names = set(ITERM_TO_VIM_MAP.values())
+    previous_base = [name for name in colors if name in base_names]
+    if previous_base != list(base_colors):
+        # Colors were added, removed or reordered, which changes what can be derived and the palette order
+        updated = build_palette(base_colors, plan)
+        changed = {name for name in colors.keys() | updated.keys() if colors.get(name) != updated.get(name)}
+        return updated, changed
+    
+    updated = colors.copy()
+    changed = set()
+    for name in base_colors:
+        rgb = base_colors.get_rgb(name)
+        if updated.get_rgb(name) != rgb:
+            updated.set_rgb(name, rgb)
+            changed.add(name)
+    changed |= update_derived_colors(updated, changed, plan)
+    
+    # Aliases share rows with their targets, so they've already changed with them
+    changed_rows = {updated.row(name) for name in changed}
+    changed |= {name for name in updated if updated.row(name) in changed_rows}
+    return updated, changed
+
+def get_variant_factors(variants, plan=None):
+    """Return the scaling factors of every variant as a (V, S, 3) array, by plan row.
+
+    Args:
+        variants: List of dicts with optional 'factors', a dict of derived
+            color names to a factor or (r, g, b) factors replacing the ones from
+            DERIVED_COLORS, and 'contrast', which scales how far every factor
+            is from 1: 0 makes derived colors copies of their bases, 2 doubles
+            the difference
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+    """
+    import numpy as np
+    plan = plan or DERIVED_COLOR_PLAN
+    defaults = np.ones((len(plan['slots']), 3))
+    for _, targets, factors in plan['levels']:
+        defaults[targets] = factors
+    scaled = {plan['names'][target] for _, targets, _ in plan['levels'] for target in targets}
+
+    result = np.repeat(defaults[np.newaxis], len(variants), axis=0)
+    for index, variant in enumerate(variants):
+        for name, factor in variant.get('factors', {}).items():
+            if name not in scaled:
+                raise ValueError(f"'{name}' isn't a derived color with a scaling factor")
+            result[index, plan['slots'][name]] = factor
+
+    contrast = np.array([variant.get('contrast', 1.0) for variant in variants]).reshape(-1, 1, 1)
+    # Leave factors of variants without a contrast level exactly as they are
+    return np.where(contrast == 1.0, result, 1 + (result - 1) * contrast)
+
+def derive_variants(colors, factors, plan=None):
+    """Calculate the derived colors of many variants at once.
+
+    Args:
+        colors: Palette or dict of color names to hex values with the base colors
+        factors: (V, S, 3) array of scaling factors from get_variant_factors()
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+
+    Returns:
+        (V, S, 3) uint8 array with every plan row (see plan['names']) of every
+        variant. Derived colors are the same as iter_derived_rgb() calculates
+        with the same factors, rows of colors whose base is missing are black.
+    """
+    import numpy as np
+    plan = plan or DERIVED_COLOR_PLAN
+    factors = np.asarray(factors, dtype=np.float64)
+    if factors.ndim != 3 or factors.shape[1:] != (len(plan['slots']), 3):
+        raise ValueError(f"Expected factors of shape (V, {len(plan['slots'])}, 3), got {factors.shape}")
+
+    get_rgb = colors.get_rgb if isinstance(colors, Palette) else lambda name: hex_to_rgb(colors.get(name))
+    rgb = np.zeros(factors.shape)
+    for name, slot in plan['base_slots']:
+        if get_rgb(name) is not None:
+            rgb[:, slot] = get_rgb(name)
+    for slot, literal_rgb in zip(plan['literal_slots'], plan['literal_rgb']):
+        rgb[:, slot] = literal_rgb
+
+    # Truncate at every level, like scale_color() does
+    for sources, targets, _ in plan['levels']:
+        rgb[:, targets] = np.floor(np.clip(rgb[:, sources] * factors[:, targets], 0.0, 255.0))
+    return rgb.astype(np.uint8)
+
+def iter_variant_palettes(colors, variants, plan=None):
+    """Yield a palette for every variant, with all variants derived in a single batch.
+
+    Args:
+        colors: Palette from parse_iterm_colors()
+        variants: List of variants, see get_variant_factors()
+        plan: Plan from compile_derived_colors(), defaults to DERIVED_COLOR_PLAN
+    """
+    plan = plan or DERIVED_COLOR_PLAN
+    scaled = [(plan['names'][target], target) for _, targets, _ in plan['levels'] for target in targets
+              if plan['names'][target] in colors]
+    with profile_stage('derivation'):
+        rows = derive_variants(colors, get_variant_factors(variants, plan), plan).tolist()
+    for variant_rows in rows:
+        palette = colors.copy()
+        for name, slot in scaled:
+            palette.set_rgb(name, tuple(variant_rows[slot]))
+        yield palette
+
+# Metrics of auto-tuning targets: WCAG contrast ratio against another color,
+# and OKLab distance times 100, which is roughly in CIE Delta E units
+TUNING_METRICS = ('contrast', 'delta_e')
+
+# Multipliers of the DERIVED_COLORS factors tried by the grid search, the
+# closest one to 1 that meets the targets is then refined by bisection
+TUNING_MAX_MULTIPLIER = 3.0
+TUNING_GRID_SIZE = 301
+TUNING_BISECTION_STEPS = 20
+
+def parse_tuning_target(value):
+    """Parse a METRIC:COLOR:OTHER:MINIMUM tuning target into a tuple.
+
+    COLOR is a derived color name, semantic color name or glob pattern like
+    '*_contrast'. An empty OTHER means the base color of COLOR.
+
+    Raises:
+        ValueError: If the target is malformed
+    """
+    parts = value.split(':')
+    if len(parts) != 4 or parts[0] not in TUNING_METRICS or not parts[1]:
+        raise ValueError(f"Tuning target must be METRIC:COLOR:OTHER:MINIMUM with a metric "
+                         f"of {TUNING_METRICS}, got '{value}'")
+    metric, color, other, minimum = parts
+    try:
+        return metric, color, other, float(minimum)
+    except ValueError:
+        raise ValueError(f"Minimum of tuning target '{value}' must be a number")
+
+def resolve_tuning_targets(targets, derived_colors, available):
+    """Expand tuning targets into dicts with the metric, derived color, other color and minimum.
+
+    Args:
+        targets: List of (metric, color, other, minimum) tuples, see parse_tuning_target()
+        derived_colors: Dict of derived color definitions, see DERIVED_COLORS
+        available: Names of the colors the palette will have
+    """
+    scaled = [name for name, info in derived_colors.items() if not is_literal_color(info[0])]
+    resolved = []
+    for metric, pattern, other, minimum in targets:
+        names = [name for name in scaled if fnmatch.fnmatchcase(name, SEMANTIC_COLORS.get(pattern, pattern))]
+        if not names:
+            raise ValueError(f"Tuning target '{pattern}' doesn't match any derived color with a factor")
+        for name in names:
+            other_name = SEMANTIC_COLORS.get(other, other) or derived_colors[name][0]
+            for color in (name, other_name):
+                if color not in available:
+                    raise ValueError(f"Can't tune '{name}' against '{other_name}': '{color}' isn't in the palette")
+            resolved.append({'metric': metric, 'color': name, 'other': other_name, 'minimum': minimum})
+    return resolved
+
+def measure_tuning_targets(rgb, targets, plan):
+    """Return a (V, T) array of the metrics of tuning targets in a (V, S, 3) array from derive_variants()."""
+    import numpy as np
+    metrics = {target['metric'] for target in targets}
+    flat = rgb.reshape(-1, 3)
+    if 'contrast' in metrics:
+        luminance = get_luminance_array(flat, 'wcag').reshape(rgb.shape[:2])
+    if 'delta_e' in metrics:
+        oklab = srgb_to_oklab(flat / 255).reshape(rgb.shape)
+
+    values = np.empty((len(rgb), len(targets)))
+    for i, target in enumerate(targets):
+        color, other = plan['slots'][target['color']], plan['slots'][target['other']]
+        if target['metric'] == 'contrast':
+            lighter = np.maximum(luminance[:, color], luminance[:, other])
+            darker = np.minimum(luminance[:, color], luminance[:, other])
+            values[:, i] = (lighter + 0.05) / (darker + 0.05)
+        else:
+            values[:, i] = np.linalg.norm(oklab[:, color] - oklab[:, other], axis=-1) * 100
+    return values
+
+def tune_derived_colors(base_colors, targets, derived_colors=None):
+    """Solve for derived color factors that meet contrast or Delta E targets.
+
+    Each targeted color gets a multiplier of its factors, the closest one to 1
+    that meets all its targets. Colors of one level of the derivation plan
+    don't depend on each other, so a whole level is solved at once: every
+    multiplier of a grid is evaluated for all its colors in a single
+    derive_variants() batch, then the edge between the closest passing and
+    failing grid points is found by bisection, again for all colors at once.
+
+    Args:
+        base_colors: Palette from parse_base_colors()
+        targets: List of (metric, color, other, minimum) tuples, see parse_tuning_target()
+        derived_colors: Dict of derived color definitions, defaults to DERIVED_COLORS
+
+    Returns:
+        Tuple of (derived color definitions with the tuned factors, list of
+        targets with the tuned factor and the metric they reach)
+
+    Raises:
+        ValueError: If a target can't be met with any multiplier up to TUNING_MAX_MULTIPLIER
+    """
+    import numpy as np
+    derived_colors = dict(derived_colors or DERIVED_COLORS)
+    plan = compile_derived_colors(derived_colors, ITERM_TO_VIM_MAP.values())
+    available = set(base_colors) | set(derive_colors(base_colors, plan))
+    resolved = resolve_tuning_targets(targets, derived_colors, available)
+    factors = get_variant_factors([{}], plan)[0]
+    grid = np.union1d(np.linspace(0.0, TUNING_MAX_MULTIPLIER, TUNING_GRID_SIZE), [1.0])
+
+    def evaluate(multipliers, slots, original, level):
+        """Return a (V, C) array of whether each color meets all its targets, for (V, C) multipliers."""
+        variant_factors = np.repeat(factors[np.newaxis], len(multipliers), axis=0)
+        variant_factors[:, slots] = original * multipliers[:, :, np.newaxis]
+        values = measure_tuning_targets(derive_variants(base_colors, variant_factors, plan), level, plan)
+        met = np.ones(multipliers.shape, dtype=bool)
+        for i, target in enumerate(level):
+            met[:, colors.index(target['color'])] &= values[:, i] >= target['minimum']
+        return met
+
+    unmet = []
+    for _, level_slots, _ in plan['levels']:
+        level = [target for target in resolved if plan['slots'][target['color']] in level_slots]
+        if not level:
+            continue
+        colors = list(dict.fromkeys(target['color'] for target in level))
+        slots = [plan['slots'][name] for name in colors]
+        original = factors[slots]
+
+        met = evaluate(np.repeat(grid[:, np.newaxis], len(colors), axis=1), slots, original, level)
+        cost = np.where(met, np.abs(grid - 1)[:, np.newaxis], np.inf)
+        best = cost.argmin(axis=0)
+        found = np.isfinite(cost.min(axis=0))
+        unmet.extend(name for name, is_found in zip(colors, found) if not is_found)
+
+        # The next grid point towards 1 fails, the edge is between the two
+        good = grid[best]
+        bad = grid[np.clip(best + np.where(good < 1, 1, -1), 0, len(grid) - 1)]
+        bad = np.where(found & (good != 1), bad, good)
+        for _ in range(TUNING_BISECTION_STEPS):
+            middle = (good + bad) / 2
+            passed = evaluate(middle[np.newaxis], slots, original, level)[0]
+            good = np.where(passed, middle, good)
+            bad = np.where(passed, bad, middle)
+        factors[slots] = original * good[:, np.newaxis]
+
+    if unmet:
+        failed = [target for target in resolved if target['color'] in unmet]
+        raise ValueError("Can't meet tuning targets: " + ', '.join(
+            f"{target['metric']} of {target['color']} against {target['other']} >= {target['minimum']:g}"
+            for target in failed))
+
+    values = measure_tuning_targets(derive_variants(base_colors, factors[np.newaxis], plan), resolved, plan)[0]
+    results = []
+    for target, value in zip(resolved, values.tolist()):
+        name = target['color']
+        tuned = factors[plan['slots'][name]].tolist()
+        base = derived_colors[name][0]
+        derived_colors[name] = (base, tuned[0]) if tuned[0] == tuned[1] == tuned[2] else (base, *tuned)
+        results.append({**target, 'factor': derived_colors[name][1:], 'value': value})
+    return derived_colors, results
+
+def parse_base_colors(iterm_colors_path, stream=False):
+    """Parse the colors of an iTerm2 colors file into a Palette of sRGB colors, without derived and semantic colors."""
+    colors = Palette()
+    
+    # Parse all colors from the iTerm file
+    parsed = []
+    with profile_stage('xml parse'):
+        for key_name, r, g, b, is_p3 in iter_iterm_colors(iterm_colors_path, ITERM_TO_VIM_MAP, stream):
+            parsed.append((ITERM_TO_VIM_MAP[key_name], (r, g, b), is_p3))
+    
+    # Convert P3 colors to sRGB, a theme only has a few dozen colors so pure Python is fastest
+    with profile_stage('p3 conversion'):
+        for vim_name, rgb, is_p3 in parsed:
+            colors.set_rgb(vim_name, to_rgb8(*(convert_color(rgb) if is_p3 else rgb)))
     
     return colors
 
-def generate_vim_colorscheme(colors, theme_name):
-    """Generate a Vim colorscheme from the color dictionary."""
-    # Convert theme name to lowercase with underscores for vim filename
-    colors_name = theme_name.lower().replace(" ", "_")
+def build_palette(base_colors, plan=None):
+    """Return a Palette of the base colors of a theme (a Palette or dict of hex values) with derived and semantic colors."""
+    if isinstance(base_colors, Palette):
+        colors = base_colors.copy()
+    else:
+        colors = Palette.from_dict(base_colors)
+    with profile_stage('derivation'):
+        # Calculate derived colors
+        for name, rgb in list(iter_derived_rgb(colors, plan)):
+            colors.set_rgb(name, rgb)
+        
+        # Add semantic colors, as aliases of their base colors
+        for semantic_name, base_color in SEMANTIC_COLORS.items():
+            if base_color in colors:
+                colors.add_alias(semantic_name, base_color)
     
-    # Start with triple quotes but no trailing backslash
-    vim_template = f"""
+    return colors
+
+def parse_iterm_colors(iterm_colors_path, stream=False):
+    """Parse iTerm2 colors file and extract colors as a Palette of sRGB colors.
+
+    Pass stream=True to parse large files with flat memory use.
+    """
+    return build_palette(parse_base_colors(iterm_colors_path, stream))
+
+# Default colors of the 16 ANSI entries of the xterm palette
+XTERM_ANSI_COLORS = [
+    (0x00, 0x00, 0x00), (0xcd, 0x00, 0x00), (0x00, 0xcd, 0x00), (0xcd, 0xcd, 0x00),
+    (0x00, 0x00, 0xee), (0xcd, 0x00, 0xcd), (0x00, 0xcd, 0xcd), (0xe5, 0xe5, 0xe5),
+    (0x7f, 0x7f, 0x7f), (0xff, 0x00, 0x00), (0x00, 0xff, 0x00), (0xff, 0xff, 0x00),
+    (0x5c, 0x5c, 0xff), (0xff, 0x00, 0xff), (0x00, 0xff, 0xff), (0xff, 0xff, 0xff),
+]
+
+# Channel levels of the 6x6x6 color cube (indices 16-231) of the xterm palette
+XTERM_CUBE_LEVELS = [0x00, 0x5f, 0x87, 0xaf, 0xd7, 0xff]
+
+# Supported numbers of cterm colors: 256 matches against the color cube and
+# grayscale ramp (16-255), which look the same in every terminal; 16 matches
+# against the ANSI colors (0-15), which terminals usually let users redefine
+CTERM_COLORS = (256, 16)
+
+# xterm palettes converted to OKLab, keyed by the number of colors
+_xterm_palettes = {}
+
+# Nearest xterm palette indices of 8-bit colors, keyed by the number of colors,
+# cleared once they grow over the limit
+_xterm_matches = {}
+XTERM_MATCH_CACHE_SIZE = 65536
+
+def get_xterm_palette(cterm_colors=256):
+    """Return a list of (index, OKLab color) of the xterm palette entries to match against.
+
+    The palette is computed on first use and cached.
+    """
+    if cterm_colors not in CTERM_COLORS:
+        raise ValueError(f"Number of cterm colors must be one of {CTERM_COLORS}")
+    if cterm_colors not in _xterm_palettes:
+        if cterm_colors == 16:
+            entries = enumerate(XTERM_ANSI_COLORS)
+        else:
+            cube = [(r, g, b) for r in XTERM_CUBE_LEVELS for g in XTERM_CUBE_LEVELS for b in XTERM_CUBE_LEVELS]
+            grays = [(level, level, level) for level in range(8, 248, 10)]
+            entries = enumerate(cube + grays, start=16)
+        _xterm_palettes[cterm_colors] = [
+            (index, srgb_to_oklab_color(r / 255, g / 255, b / 255)) for index, (r, g, b) in entries
+        ]
+    return _xterm_palettes[cterm_colors]
+
+def quantize_to_xterm(colors, cterm_colors=256):
+    """Find the perceptually nearest xterm palette index for each color.
+
+    Distances are measured in OKLab. The first entry wins ties. Matches are
+    kept across calls, so colors shared by several palettes, like the base
+    colors of theme variants, are only matched once.
+
+    Args:
+        colors: Iterable of (r, g, b) tuples with 8-bit sRGB values
+        cterm_colors: Number of terminal colors, see CTERM_COLORS
+
+    Returns:
+        List of xterm palette indices
+    """
+    palette = get_xterm_palette(cterm_colors)
+    nearest = _xterm_matches.setdefault(cterm_colors, {})
+    if len(nearest) > XTERM_MATCH_CACHE_SIZE:
+        nearest.clear()
+    indices = []
+    for color in colors:
+        color = tuple(color)
+        # Read the match once, another thread may clear the cache in between
+        index = nearest.get(color)
+        if index is None:
+            lightness, a, b = srgb_to_oklab_color(*(value / 255 for value in color))
+            index = min(
+                palette,
+                key=lambda entry: ((lightness - entry[1][0]) ** 2 + (a - entry[1][1]) ** 2
+                                   + (b - entry[1][2]) ** 2),
+            )[0]
+            nearest[color] = index
+        indices.append(index)
+    return indices
+
+# Highlight groups of the colorscheme, one dict per fold of the generated file.
+# Specs use the same keys as s:squirrelsong_hl(): fg and bg are palette color
+# names, style is a Vim attribute list like 'bold' or 'italic'.
+HIGHLIGHT_GROUPS = [
+    ('UI', {
+        'Normal': {'fg': 'fg', 'bg': 'bg'},
+        'Statusline': {'fg': 'fg', 'bg': 'gray0a'},
+        'StatuslineNC': {'fg': 'fg', 'bg': 'gray0b'},
+        'IncSearch': {'bg': 'bright_yellow_light'},
+        'Search': {'bg': 'bright_yellow_light'},
+        'Folded': {'fg': 'fg', 'bg': 'gray0a'},
+        'Visual': {'fg': 'none', 'bg': 'bright_yellow_light'},
+    }),
+    ('Vanilla Syntax', {
+        'Type': {'fg': 'teal', 'style': 'bold'},
+        'Structure': {'fg': 'teal', 'style': 'bold'},
+        'StorageClass': {'fg': 'blue', 'style': 'italic'},
+        'Identifier': {'fg': 'blue', 'style': 'italic'},
+        'PreProc': {'fg': 'red'},
+        'PreCondit': {'fg': 'purple'},
+        'Include': {'fg': 'purple', 'style': 'bold'},
+        'Keyword': {'fg': 'purple'},
+        'Define': {'fg': 'red'},
+        'Typedef': {'fg': 'red'},
+        'Exception': {'fg': 'red'},
+        'Conditional': {'fg': 'purple'},
+        'Repeat': {'fg': 'purple'},
+        'Statement': {'fg': 'purple'},
+        'Macro': {'fg': 'purple'},
+        'Error': {'fg': 'red'},
+        'Label': {'fg': 'purple'},
+        'Special': {'fg': 'purple'},
+        'SpecialChar': {'fg': 'purple'},
+        'Boolean': {'fg': 'purple'},
+        'String': {'fg': 'green'},
+        'Character': {'fg': 'orange'},
+        'Number': {'fg': 'orange'},
+        'Float': {'fg': 'purple'},
+        'Function': {'fg': 'blue', 'style': 'bold'},
+        'Operator': {'fg': 'red'},
+        'Title': {'fg': 'red', 'style': 'bold'},
+        'Tag': {'fg': 'orange'},
+        'Delimiter': {'fg': 'fg'},
+        'Todo': {'fg': 'bg', 'bg': 'blue', 'style': 'bold'},
+        'Comment': {'fg': 'comment', 'style': 'italic'},
+        'SpecialComment': {'fg': 'comment', 'style': 'italic'},
+        'Ignore': {'fg': 'gray09'},
+        'Underlined': {'style': 'underline'},
+        'Whitespace': {'fg': 'gray0b'},
+    }),
+    ('Predefined Highlight Groups', {
+        'Fg': {'fg': 'fg'},
+        'Gray': {'fg': 'gray07'},
+        'Red': {'fg': 'red'},
+        'Orange': {'fg': 'orange'},
+        'Yellow': {'fg': 'yellow'},
+        'Green': {'fg': 'green'},
+        'Blue': {'fg': 'blue'},
+        'Purple': {'fg': 'purple'},
+        'Teal': {'fg': 'teal'},
+        'RedItalic': {'fg': 'red', 'style': 'italic'},
+        'GrayItalic': {'fg': 'gray07', 'style': 'italic'},
+        'OrangeItalic': {'fg': 'orange', 'style': 'italic'},
+        'YellowItalic': {'fg': 'yellow', 'style': 'italic'},
+        'GreenItalic': {'fg': 'green', 'style': 'italic'},
+        'BlueItalic': {'fg': 'blue', 'style': 'italic'},
+        'PurpleItalic': {'fg': 'purple', 'style': 'italic'},
+        'TealItalic': {'fg': 'teal', 'style': 'italic'},
+        'RedBold': {'fg': 'red', 'style': 'bold'},
+        'GrayBold': {'fg': 'gray07', 'style': 'bold'},
+        'OrangeBold': {'fg': 'orange', 'style': 'bold'},
+        'YellowBold': {'fg': 'yellow', 'style': 'bold'},
+        'GreenBold': {'fg': 'green', 'style': 'bold'},
+        'BlueBold': {'fg': 'blue', 'style': 'bold'},
+        'PurpleBold': {'fg': 'purple', 'style': 'bold'},
+        'TealBold': {'fg': 'teal', 'style': 'bold'},
+    }),
+]
+
+# Groups that look different in diff mode (&diff) and in regular editing
+DIFF_MODE_HIGHLIGHT_GROUPS = {
+    'CursorLine': {'style': 'underline'},
+    'ColorColumn': {'style': 'bold'},
+}
+REGULAR_MODE_HIGHLIGHT_GROUPS = {
+    'CursorLine': {'bg': 'gray0b'},
+    'ColorColumn': {'bg': 'gray0b'},
+}
+
+def get_vim_header(theme_name):
+    """Return the comment header and options shared by all Vim colorscheme variants."""
+    return f"""
 " =============================================================================
 " Name:         {theme_name}
 " Description:  Low contrast dark theme for web developers.
@@ -308,21 +1525,69 @@ def generate_vim_colorscheme(colors, theme_name):
 " Set to v:false to disable everything but color
 let g:squirrelsong_color_only = get(g:, 'squirrelsong_color_only', v:false)
 
-" Initialization: {{{{
-let s:palette = {{
+"""
+
+def get_vim_palette(colors, cterm_colors=256):
+    """Return a dict of color names to [gui, cterm] pairs, with the nearest xterm colors for cterm."""
+    if not isinstance(colors, Palette):
+        colors = Palette.from_dict(colors)
+    # Match every buffer row once, aliases share the result
+    rows = colors.view().tolist()
+    cterm = quantize_to_xterm(rows, cterm_colors) if rows else []
+    palette = {}
+    for name in colors:
+        row = colors.row(name)
+        palette[name] = ('NONE', 'NONE') if row is None else (colors[name], str(cterm[row]))
+    return palette
+
+def get_palette_entry(palette, color_name):
+    """Return the [gui, cterm] pair of a palette color."""
+    if color_name not in palette:
+        raise ValueError(f"Color '{color_name}' isn't in the palette")
+    return palette[color_name]
+
+def format_vim_spec(spec):
+    """Format a highlight spec as a Vim dict literal referencing s:palette."""
+    items = [f"'{key}': s:palette.{value}" if key in ('fg', 'bg') else f"'{key}': '{value}'"
+             for key, value in spec.items()]
+    return '{ ' + ', '.join(items) + ' }'
+
+def format_vim_extend(groups, indent=''):
+    """Format a `call extend(colors, {...})` statement for a dict of highlight groups."""
+    lines = [f"{indent}call extend(colors, {{"]
+    for group, spec in groups.items():
+        lines.append(f"{indent}      \\ '{group}': {format_vim_spec(spec)},")
+    lines.append(f"{indent}      \\ }})")
+    return '\n'.join(lines) + '\n'
+
+def format_vim_highlight(palette, group, spec):
+    """Format a flat `highlight` command the same way s:squirrelsong_hl() builds it, without the style."""
+    guifg, ctermfg = get_palette_entry(palette, spec['fg']) if 'fg' in spec else ('NONE', 'NONE')
+    guibg, ctermbg = get_palette_entry(palette, spec['bg']) if 'bg' in spec else ('NONE', 'NONE')
+    return (f"highlight {group} guifg={guifg} ctermfg={ctermfg} "
+            f"guibg={guibg} ctermbg={ctermbg} gui=NONE cterm=NONE")
+
+def iter_vim_colorscheme(colors, theme_name, cterm_colors=256):
+    """Generate a Vim colorscheme from the color dictionary, chunk by chunk."""
+    # Convert theme name to lowercase with underscores for vim filename
+    colors_name = theme_name.lower().replace(" ", "_")
+    palette = get_vim_palette(colors, cterm_colors)
+    
+    yield get_vim_header(theme_name) + """" Initialization: {{
+let s:palette = {
 """
     # Fix: using raw strings to prevent escape sequence warnings
     # Add all colors to the palette
-    for i, (color_name, hex_value) in enumerate(sorted(colors.items())):
+    for i, (color_name, (gui, cterm)) in enumerate(sorted(palette.items())):
         # Add comma to all lines except the last one
-        comma = "," if i < len(colors) - 1 else ""
+        comma = "," if i < len(palette) - 1 else ""
         if color_name == 'none':
-            vim_template += f"  \\ 'none':                  ['NONE',      'NONE']{comma}\n"
+            yield f"  \\ 'none':                  ['NONE',      'NONE']{comma}\n"
         else:
-            vim_template += f"  \\ '{color_name}':                  ['{hex_value}',   'NONE']{comma}\n"
+            yield f"  \\ '{color_name}':                  ['{gui}',   '{cterm}']{comma}\n"
     
-    vim_template += r"""
-  \ }
+    # No blank line before the closing brace, it would end the line continuation
+    yield r"""  \ }
 
 " Apply a highlight style
 " @group: The name of the group for the highlight
@@ -378,103 +1643,17 @@ let colors = {}
 
 " Common Highlight Groups {{{{
 
-" UI {{{{
-call extend(colors, {
-      \ 'Normal':           { 'fg': s:palette.fg, 'bg': s:palette.bg     },
-      \ 'Statusline':       { 'fg': s:palette.fg, 'bg': s:palette.gray0a },
-      \ 'StatuslineNC':     { 'fg': s:palette.fg, 'bg': s:palette.gray0b },
-      \ 'IncSearch':        { 'bg': s:palette.bright_yellow_light },
-      \ 'Search':           {  'bg': s:palette.bright_yellow_light },
-      \ 'Folded':           { 'fg': s:palette.fg, 'bg': s:palette.gray0a },
-      \ 'Visual':           { 'fg': s:palette.none, 'bg': s:palette.bright_yellow_light },
-      \ })
-" }}}}
-
-" Vanilla Syntax {{{{
-call extend(colors, {
-      \ 'Type': { 'fg': s:palette.teal, 'style': 'bold' },
-      \ 'Structure': { 'fg': s:palette.teal, 'style': 'bold' },
-      \ 'StorageClass': { 'fg': s:palette.blue, 'style': 'italic' },
-      \ 'Identifier': { 'fg': s:palette.blue, 'style': 'italic' },
-      \ 'PreProc': { 'fg': s:palette.red },
-      \ 'PreCondit': { 'fg': s:palette.purple },
-      \ 'Include': { 'fg': s:palette.purple, 'style': 'bold' },
-      \ 'Keyword': { 'fg': s:palette.purple },
-      \ 'Define': { 'fg': s:palette.red },
-      \ 'Typedef': { 'fg': s:palette.red },
-      \ 'Exception': { 'fg': s:palette.red },
-      \ 'Conditional': { 'fg': s:palette.purple },
-      \ 'Repeat': { 'fg': s:palette.purple },
-      \ 'Statement': { 'fg': s:palette.purple },
-      \ 'Macro': { 'fg': s:palette.purple },
-      \ 'Error': { 'fg': s:palette.red },
-      \ 'Label': { 'fg': s:palette.purple },
-      \ 'Special': { 'fg': s:palette.purple },
-      \ 'SpecialChar': { 'fg': s:palette.purple },
-      \ 'Boolean': { 'fg': s:palette.purple },
-      \ 'String': { 'fg': s:palette.green },
-      \ 'Character': { 'fg': s:palette.orange },
-      \ 'Number': { 'fg': s:palette.orange },
-      \ 'Float': { 'fg': s:palette.purple },
-      \ 'Function': { 'fg': s:palette.blue, 'style':  'bold' },
-      \ 'Operator': { 'fg': s:palette.red },
-      \ 'Title': { 'fg': s:palette.red, 'style': 'bold' },
-      \ 'Tag': { 'fg': s:palette.orange },
-      \ 'Delimiter': { 'fg': s:palette.fg },
-      \ 'Todo': { 'fg': s:palette.bg, 'bg': s:palette.blue, 'style': 'bold' },
-      \ 'Comment': { 'fg': s:palette.comment, 'style': 'italic' },
-      \ 'SpecialComment': { 'fg': s:palette.comment, 'style': 'italic' },
-      \ 'Ignore': { 'fg': s:palette.gray09 },
-      \ 'Underlined': { 'style': 'underline' },
-      \ 'Whitespace': { 'fg': s:palette.gray0b },
-      \ })
-
-if &diff
-  call extend(colors, {
-        \ 'CursorLine': { 'style': 'underline' },
-        \ 'ColorColumn': { 'style': 'bold' },
-        \ })
-else
-  call extend(colors, {
-        \ 'CursorLine': { 'bg': s:palette.gray0b},
-        \ 'ColorColumn': { 'bg': s:palette.gray0b },
-        \ })
-endif
-" }}}}
-
-" Predefined Highlight Groups: {{{{
-call extend(colors, {
-      \ 'Fg': { 'fg': s:palette.fg },
-      \ 'Gray': { 'fg': s:palette.gray07 },
-      \ 'Red': { 'fg': s:palette.red },
-      \ 'Orange': { 'fg': s:palette.orange },
-      \ 'Yellow': { 'fg': s:palette.yellow },
-      \ 'Green': { 'fg': s:palette.green },
-      \ 'Blue': { 'fg': s:palette.blue },
-      \ 'Purple': { 'fg': s:palette.purple },
-      \ 'Teal': { 'fg': s:palette.teal },
-      \
-      \ 'RedItalic': { 'fg': s:palette.red, 'style': 'italic' },
-      \ 'GrayItalic': { 'fg': s:palette.gray07, 'style': 'italic' },
-      \ 'OrangeItalic': { 'fg': s:palette.orange, 'style': 'italic' },
-      \ 'YellowItalic': { 'fg': s:palette.yellow, 'style': 'italic' },
-      \ 'GreenItalic': { 'fg': s:palette.green, 'style': 'italic' },
-      \ 'BlueItalic': { 'fg': s:palette.blue, 'style': 'italic' },
-      \ 'PurpleItalic': { 'fg': s:palette.purple, 'style': 'italic' },
-      \ 'TealItalic': { 'fg': s:palette.teal, 'style': 'italic' },
-      \
-      \ 'RedBold': { 'fg': s:palette.red, 'style': 'bold' },
-      \ 'GrayBold': { 'fg': s:palette.gray07, 'style': 'bold' },
-      \ 'OrangeBold': { 'fg': s:palette.orange, 'style': 'bold' },
-      \ 'YellowBold': { 'fg': s:palette.yellow, 'style': 'bold' },
-      \ 'GreenBold': { 'fg': s:palette.green, 'style': 'bold' },
-      \ 'BlueBold': { 'fg': s:palette.blue, 'style': 'bold' },
-      \ 'PurpleBold': { 'fg': s:palette.purple, 'style': 'bold' },
-      \ 'TealBold': { 'fg': s:palette.teal, 'style': 'bold' },
-      \ })
-" }}}}
-
-" }}}}
+"""
+    for title, groups in HIGHLIGHT_GROUPS:
+        yield f'" {title} {{{{{{{{\n' + format_vim_extend(groups) + '" }}}}\n\n'
+    
+    yield '" Diff Mode {{{{\nif &diff\n'
+    yield format_vim_extend(DIFF_MODE_HIGHLIGHT_GROUPS, '  ')
+    yield 'else\n'
+    yield format_vim_extend(REGULAR_MODE_HIGHLIGHT_GROUPS, '  ')
+    yield 'endif\n" }}}}\n\n'
+    
+    yield r"""" }}}}
 
 " Include the rest of your highlight groups here...
 
@@ -484,38 +1663,1020 @@ endfor
 
 " vim: set filetype=vim foldmethod=marker foldmarker={{{{,}}}}:
 """
-    return vim_template
 
-def main():
-    # Check for command line arguments
-    if len(sys.argv) < 2:
-        print("Usage: python scheme.py <iterm_colors_file> [output_vim_file]")
-        sys.exit(1)
+def generate_vim_colorscheme(colors, theme_name, cterm_colors=256):
+    """Generate a Vim colorscheme from the color dictionary."""
+    return ''.join(iter_vim_colorscheme(colors, theme_name, cterm_colors))
+
+def iter_compiled_vim_colorscheme(colors, theme_name, cterm_colors=256):
+    """Generate a Vim colorscheme with every highlight resolved to a flat `highlight` command.
+
+    Produces the same highlights as iter_vim_colorscheme(), but without
+    building the palette and calling a function for every group when Vim
+    loads it. The g:squirrelsong_color_only option and diff mode are handled
+    by two small precomputed blocks.
+    """
+    colors_name = theme_name.lower().replace(" ", "_")
+    palette = get_vim_palette(colors, cterm_colors)
+    
+    yield get_vim_header(theme_name) + """highlight clear
+if exists('syntax_on')
+  syntax reset
+endif
+
+let g:colors_name = '""" + colors_name + """'
+
+"""
+    
+    for title, groups in HIGHLIGHT_GROUPS:
+        yield f'" {title} {{{{{{{{\n'
+        yield ''.join(format_vim_highlight(palette, group, spec) + '\n' for group, spec in groups.items())
+        yield '" }}}}\n\n'
+    
+    yield '" Diff Mode {{{{\nif &diff\n'
+    yield ''.join('  ' + format_vim_highlight(palette, group, spec) + '\n'
+                  for group, spec in DIFF_MODE_HIGHLIGHT_GROUPS.items())
+    yield 'else\n'
+    yield ''.join('  ' + format_vim_highlight(palette, group, spec) + '\n'
+                  for group, spec in REGULAR_MODE_HIGHLIGHT_GROUPS.items())
+    yield 'endif\n" }}}}\n\n'
+    
+    # Styles are applied on top of the colors, unless disabled
+    yield '" Styles {{{{\nif !g:squirrelsong_color_only\n'
+    for _, groups in HIGHLIGHT_GROUPS:
+        yield ''.join(f"  highlight {group} gui={spec['style']} cterm={spec['style']}\n"
+                      for group, spec in groups.items() if 'style' in spec)
+    diff_styles = [f"    highlight {group} gui={spec['style']} cterm={spec['style']}\n"
+                   for group, spec in DIFF_MODE_HIGHLIGHT_GROUPS.items() if 'style' in spec]
+    regular_styles = [f"    highlight {group} gui={spec['style']} cterm={spec['style']}\n"
+                      for group, spec in REGULAR_MODE_HIGHLIGHT_GROUPS.items() if 'style' in spec]
+    if diff_styles or regular_styles:
+        yield '  if &diff\n' + ''.join(diff_styles)
+        if regular_styles:
+            yield '  else\n' + ''.join(regular_styles)
+        yield '  endif\n'
+    yield 'endif\n" }}}}\n\n'
+    
+    yield '" vim: set filetype=vim foldmethod=marker foldmarker={{{{,}}}}:\n'
+
+def generate_compiled_vim_colorscheme(colors, theme_name, cterm_colors=256):
+    """Generate a precompiled Vim colorscheme, see iter_compiled_vim_colorscheme()."""
+    return ''.join(iter_compiled_vim_colorscheme(colors, theme_name, cterm_colors))
+
+# Contrast metrics: WCAG 2 contrast ratio (1 to 21) and APCA lightness
+# contrast (Lc, -108 to 106, negative for light text on dark backgrounds)
+CONTRAST_METHODS = ('wcag', 'apca')
+
+# Lowest acceptable contrast of highlight groups: WCAG AA for body text, and
+# the matching APCA level
+DEFAULT_MIN_CONTRAST = {'wcag': 4.5, 'apca': 60}
+
+# Bump when contrast is computed differently, to invalidate cached matrices
+CONTRAST_VERSION = 1
+
+def get_luminance_array(rgb, method='wcag'):
+    """Return the luminance of an (N, 3) array of 8-bit colors, as the contrast method defines it."""
+    import numpy as np
+    values = np.asarray(rgb, dtype=np.float64) / 255
+    if method == 'wcag':
+        # WCAG linearizes below 0.03928 instead of 0.04045, no 8-bit value
+        # falls between the two
+        return gamma_encode_array(values) @ np.array([0.2126, 0.7152, 0.0722])
+    # APCA 0.0.98G uses a plain 2.4 power and soft clamps near black
+    luminance = values ** 2.4 @ np.array([0.2126729, 0.7151522, 0.0721750])
+    return np.where(luminance < 0.022, luminance + np.maximum(0.022 - luminance, 0) ** 1.414, luminance)
+
+def compute_contrast_matrix(rgb, method='wcag'):
+    """Return the (N, N) contrast matrix of an (N, 3) array of 8-bit colors.
+
+    Rows are text colors and columns are backgrounds. WCAG ratios are
+    symmetric, APCA Lc values aren't.
+    """
+    import numpy as np
+    if method not in CONTRAST_METHODS:
+        raise ValueError(f"Contrast method must be one of {CONTRAST_METHODS}")
+    luminance = get_luminance_array(rgb, method)
+    text = luminance[:, np.newaxis]
+    background = luminance[np.newaxis, :]
+    if method == 'wcag':
+        return (np.maximum(text, background) + 0.05) / (np.minimum(text, background) + 0.05)
+
+    normal = (background ** 0.56 - text ** 0.57) * 1.14
+    reverse = (background ** 0.65 - text ** 0.62) * 1.14
+    contrast = np.where(background > text,
+                        np.where(normal < 0.1, 0, normal - 0.027),
+                        np.where(reverse > -0.1, 0, reverse + 0.027))
+    return np.where(np.abs(background - text) < 0.0005, 0, contrast * 100)
+
+def get_contrast_cache_key(colors, method):
+    """Hash everything a contrast matrix depends on: the palette buffer, method and version."""
+    digest = hashlib.sha256(f'contrast\0{CONTRAST_VERSION}\0{method}\0'.encode())
+    digest.update(bytes(colors.view()))
+    return digest.hexdigest()
+
+def get_contrast_matrix(colors, method='wcag', use_cache=True):
+    """Return the contrast matrix of the buffer rows of a palette as nested lists.
+
+    See compute_contrast_matrix() for the layout and Palette.row() for the rows
+    of colors. Matrices are kept in the build cache, so checking an unchanged
+    palette doesn't even import NumPy.
+    """
+    if method not in CONTRAST_METHODS:
+        raise ValueError(f"Contrast method must be one of {CONTRAST_METHODS}")
+    if not isinstance(colors, Palette):
+        colors = Palette.from_dict(colors)
+
+    entry = None
+    if use_cache:
+        with profile_stage('cache'):
+            cache_dir = get_build_cache_dir()
+            cache_key = get_contrast_cache_key(colors, method)
+            entry = read_build_cache(cache_key, cache_dir)
+    if entry is not None:
+        return entry['matrix']
+
+    with profile_stage('contrast'):
+        rows = colors.view().tolist()
+        matrix = compute_contrast_matrix(rows, method).tolist() if rows else []
+    if use_cache:
+        with profile_stage('cache'):
+            write_build_cache(cache_key, {'matrix': matrix}, cache_dir)
+    return matrix
+
+def get_highlight_color_pairs():
+    """Return (group, fg, bg) color names of the highlight groups with colors.
+
+    Groups without a text or background color show the Normal one, and so do
+    groups with 'none' text, like Visual, which keeps the syntax colors. Diff
+    mode only changes styles, so regular mode groups are used.
+    """
+    normal = HIGHLIGHT_GROUPS[0][1]['Normal']
+    groups = [group for _, mode_groups in HIGHLIGHT_GROUPS for group in mode_groups.items()]
+    groups.extend(REGULAR_MODE_HIGHLIGHT_GROUPS.items())
+    pairs = []
+    for group, spec in groups:
+        if 'fg' not in spec and 'bg' not in spec:
+            continue
+        fg = spec.get('fg', 'none')
+        pairs.append((group, normal['fg'] if fg == 'none' else fg, spec.get('bg', normal['bg'])))
+    return pairs
+
+def get_contrast_report(colors, method='wcag', min_contrast=None, use_cache=True):
+    """Measure the contrast between every pair of palette colors and of every highlight group.
+
+    Args:
+        colors: Palette or dict of color names to hex values
+        method: Contrast metric, see CONTRAST_METHODS
+        min_contrast: Lowest acceptable WCAG ratio or absolute APCA Lc,
+            defaults to DEFAULT_MIN_CONTRAST
+        use_cache: Whether to use the build cache
+
+    Returns:
+        Dict with the method, minimum contrast, names of the colors, contrast
+        matrix of those colors (text by rows, backgrounds by columns), and
+        a list of highlight groups with their fg, bg, contrast and whether it
+        passed. Groups whose colors are missing from the palette or NONE
+        aren't colored by the colorscheme and are left out.
+    """
+    if not isinstance(colors, Palette):
+        colors = Palette.from_dict(colors)
+    if min_contrast is None:
+        min_contrast = DEFAULT_MIN_CONTRAST[method]
+    matrix = get_contrast_matrix(colors, method, use_cache)
+
+    names = [name for name in colors if colors.row(name) is not None]
+    rows = [colors.row(name) for name in names]
+    groups = []
+    for group, fg, bg in get_highlight_color_pairs():
+        if colors.get_rgb(fg) is None or colors.get_rgb(bg) is None:
+            continue
+        contrast = matrix[colors.row(fg)][colors.row(bg)]
+        groups.append({'group': group, 'fg': fg, 'bg': bg, 'contrast': contrast,
+                       'passed': abs(contrast) >= min_contrast})
+    return {
+        'method': method,
+        'min_contrast': min_contrast,
+        'colors': names,
+        'matrix': [[matrix[text][background] for background in rows] for text in rows],
+        'groups': groups,
+    }
+
+def write_contrast_report(path, report):
+    """Save a contrast report to a .json file, or its contrast matrix to a .csv file."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.csv', '.json'):
+        raise ValueError(f"Contrast report must be a .csv or .json file, got '{path}'")
+    with open(path, 'w', newline='') as f:
+        if extension == '.json':
+            json.dump(report, f, indent=2)
+            f.write('\n')
+            return
+        writer = csv.writer(f)
+        writer.writerow([f"{report['method']} (text \\ background)", *report['colors']])
+        for name, row in zip(report['colors'], report['matrix']):
+            writer.writerow([name, *(f'{value:.2f}' for value in row)])
+
+# Palette names of the 16 ANSI colors, by ANSI index
+ANSI_COLOR_NAMES = {
+    int(key.split()[1]): name
+    for key, name in ITERM_TO_VIM_MAP.items() if key.startswith('Ansi ')
+}
+
+def format_lua_highlight(palette, group, spec, indent=''):
+    """Format a nvim_set_hl() call for a highlight group."""
+    attributes = []
+    for key in ('fg', 'bg'):
+        if key in spec:
+            gui, cterm = get_palette_entry(palette, spec[key])
+            if gui != 'NONE':
+                attributes.append(f"{key} = '{gui}'")
+            if cterm != 'NONE':
+                attributes.append(f"cterm{key} = {cterm}")
+    # Styles are switched off at load time when g:squirrelsong_color_only is set
+    if 'style' in spec:
+        attributes.extend(f"{style} = styled" for style in spec['style'].split(','))
+    return f"{indent}hl(0, '{group}', {{ {', '.join(attributes)} }})\n"
+
+def iter_neovim_colorscheme(colors, theme_name, cterm_colors=256):
+    """Generate a Neovim Lua colorscheme with the same highlights as the Vim one, chunk by chunk."""
+    colors_name = theme_name.lower().replace(" ", "_")
+    palette = get_vim_palette(colors, cterm_colors)
+    
+    yield f"""-- =============================================================================
+-- Name:         {theme_name}
+-- Description:  Low contrast dark theme for web developers.
+-- URL:          https://github.com/sapegin/squirrelsong/
+-- License:      MIT
+-- =============================================================================
+
+-- Set g:squirrelsong_color_only to disable everything but color
+local color_only = vim.g.squirrelsong_color_only
+local styled = not (color_only == true or color_only == 1)
+
+vim.cmd('highlight clear')
+if vim.fn.exists('syntax_on') == 1 then
+  vim.cmd('syntax reset')
+end
+
+vim.g.colors_name = '{colors_name}'
+
+local hl = vim.api.nvim_set_hl
+
+"""
+    for title, groups in HIGHLIGHT_GROUPS:
+        yield f"-- {title}\n"
+        yield ''.join(format_lua_highlight(palette, group, spec) for group, spec in groups.items())
+        yield "\n"
+    
+    yield "-- Diff Mode\nif vim.o.diff then\n"
+    yield ''.join(format_lua_highlight(palette, group, spec, '  ')
+                  for group, spec in DIFF_MODE_HIGHLIGHT_GROUPS.items())
+    yield "else\n"
+    yield ''.join(format_lua_highlight(palette, group, spec, '  ')
+                  for group, spec in REGULAR_MODE_HIGHLIGHT_GROUPS.items())
+    yield "end\n"
+
+def iter_json_palette(colors, theme_name, cterm_colors=256):
+    """Generate a JSON palette with the gui and cterm values of every color, chunk by chunk."""
+    palette = get_vim_palette(colors, cterm_colors)
+    data = {
+        'name': theme_name,
+        'colors': {
+            name: {
+                'gui': None if gui == 'NONE' else gui,
+                'cterm': None if cterm == 'NONE' else int(cterm),
+            }
+            for name, (gui, cterm) in palette.items()
+        },
+    }
+    yield from json.JSONEncoder(indent=2).iterencode(data)
+    yield "\n"
+
+def iter_ghostty_theme(colors, theme_name, cterm_colors=256):
+    """Generate a Ghostty terminal theme, chunk by chunk.
+
+    Terminals only use gui colors, so cterm_colors is ignored.
+    """
+    yield f"# {theme_name} Theme for Ghostty\n# https://sapegin.me/squirrelsong/\n\n"
+    for key, color_name in [('foreground', 'fg'), ('background', 'bg'),
+                            ('selection-foreground', 'fg'), ('selection-background', 'selection'),
+                            ('cursor-color', 'cursor')]:
+        if color_name in colors:
+            yield f"{key} = {colors[color_name]}\n"
+    yield "\n"
+    for index, color_name in sorted(ANSI_COLOR_NAMES.items()):
+        if color_name in colors:
+            yield f"palette = {index}={colors[color_name]}\n"
+
+def iter_binary_palette(colors, theme_name, cterm_colors=256):
+    """Generate the resolved palette in the binary palette format, see PALETTE_HEADER.
+
+    Only gui colors are stored, so cterm_colors is ignored.
+    """
+    if not isinstance(colors, Palette):
+        colors = Palette.from_dict(colors)
+    yield colors.to_bytes()
+
+def iter_palette_json(colors, theme_name, cterm_colors=256):
+    """Generate the resolved palette as JSON, the readable variant of iter_binary_palette(), chunk by chunk."""
+    if not isinstance(colors, Palette):
+        colors = Palette.from_dict(colors)
+    data = {
+        'format': 'squirrelsong-palette',
+        'version': PALETTE_FORMAT_VERSION,
+        'name': theme_name,
+        'colors': colors.to_dict(),
+        'aliases': colors.get_aliases(),
+    }
+    yield from json.JSONEncoder(indent=2).iterencode(data)
+    yield "\n"
+
+def read_palette_file(path):
+    """Load a palette saved by the palette or palette-json targets.
+
+    Binary files are memory-mapped and copied straight into the palette
+    buffer, without any parsing or color math.
+
+    Raises:
+        ValueError: If the file isn't a palette file
+    """
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('format') != 'squirrelsong-palette' or data.get('version') != PALETTE_FORMAT_VERSION:
+            raise ValueError(f"'{path}' isn't a palette file of version {PALETTE_FORMAT_VERSION}")
+        return Palette.from_dict(data['colors'], data['aliases'])
+    
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"'{path}' is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return Palette.from_buffer(data)
+
+def load_palette_array(path):
+    """Return the RGB rows of a binary palette file as a read-only (rows, 3) uint8 NumPy memory map.
+
+    Only the header is read, see Palette.row() for the rows of colors.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        header = f.read(PALETTE_HEADER.size)
+    if len(header) < PALETTE_HEADER.size or header[:4] != PALETTE_MAGIC:
+        raise ValueError(f"'{path}' isn't a palette file")
+    _, version, _, row_count, _, rgb_offset = PALETTE_HEADER.unpack(header)
+    if version != PALETTE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported palette format version {version}")
+    # Empty files can't be mapped
+    if row_count == 0:
+        return np.empty((0, 3), dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=rgb_offset, shape=(row_count, 3))
+
+# Squirrelsong Dark iTerm2 theme, the palette the helper scripts use by default
+DEFAULT_THEME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'themes', 'iTerm2', 'Squirrelsong Dark.itermcolors')
+
+def get_theme_name(iterm_colors_path):
+    """Get the theme name from the file name."""
+    return os.path.splitext(os.path.basename(iterm_colors_path))[0]
+
+def get_vim_file_name(theme_name):
+    """Get the Vim colorscheme file name for a theme."""
+    return f"{theme_name.lower().replace(' ', '_')}.vim"
+
+# Output targets: description, output file name for a theme name, and a
+# function that renders (colors, theme_name, cterm_colors) to string chunks
+RENDERERS = {
+    'vim': ('Vim colorscheme', get_vim_file_name, iter_vim_colorscheme),
+    'vim-compiled': ('Vim colorscheme', get_vim_file_name, iter_compiled_vim_colorscheme),
+    'lua': ('Neovim colorscheme', lambda theme_name: f"{theme_name.lower().replace(' ', '_')}.lua",
+            iter_neovim_colorscheme),
+    'json': ('JSON palette', lambda theme_name: f"{theme_name.lower().replace(' ', '_')}.json",
+             iter_json_palette),
+    'ghostty': ('Ghostty theme', lambda theme_name: theme_name, iter_ghostty_theme),
+    'palette': ('Binary palette', lambda theme_name: f"{theme_name.lower().replace(' ', '_')}.sqpalette",
+                iter_binary_palette),
+    'palette-json': ('Palette', lambda theme_name: f"{theme_name.lower().replace(' ', '_')}.palette.json",
+                     iter_palette_json),
+}
+
+# Bump when the generated output changes in a way the mapping tables don't
+# capture (e.g. the Vim template), to invalidate the build cache
+CONVERTER_VERSION = 5
+
+# Size limit of the build cache, least recently used entries are evicted past it
+BUILD_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+def get_build_cache_dir():
+    """Return the build cache directory, creating it if needed."""
+    cache_dir = os.path.join(get_cache_dir(), 'build')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def get_build_cache_key(input_bytes, theme_name, cterm_colors=256, tuning_targets=()):
+    """Hash everything a conversion depends on: input content, theme name, render and tuning options, converter version, mapping and highlight tables."""
+    digest = hashlib.sha256(f'{CONVERTER_VERSION}\0{theme_name}\0{cterm_colors}\0'.encode())
+    digest.update(json.dumps([ITERM_TO_VIM_MAP, DERIVED_COLORS, SEMANTIC_COLORS, list(tuning_targets)]).encode())
+    digest.update(json.dumps([HIGHLIGHT_GROUPS, DIFF_MODE_HIGHLIGHT_GROUPS, REGULAR_MODE_HIGHLIGHT_GROUPS]).encode())
+    digest.update(input_bytes)
+    return digest.hexdigest()
+
+def read_build_cache(key, cache_dir):
+    """Return a cached conversion result, or None if there's no usable entry."""
+    entry_path = os.path.join(cache_dir, f'{key}.json')
+    try:
+        with open(entry_path) as f:
+            entry = json.load(f)
+        # Mark the entry as recently used for eviction
+        os.utime(entry_path)
+    except (OSError, ValueError):
+        return None
+    return entry
+
+def write_build_cache(key, entry, cache_dir, max_bytes=BUILD_CACHE_MAX_BYTES):
+    """Store a conversion result and evict old entries if the cache is over its size limit."""
+    entry_path = os.path.join(cache_dir, f'{key}.json')
+    temp_path = f'{entry_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(temp_path, entry_path)
+    evict_build_cache(cache_dir, max_bytes)
+
+def evict_build_cache(cache_dir, max_bytes=BUILD_CACHE_MAX_BYTES):
+    """Remove least recently used cache entries until the cache fits into max_bytes."""
+    entries = []
+    for dir_entry in os.scandir(cache_dir):
+        if dir_entry.name.endswith('.json'):
+            stat = dir_entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass  # Already evicted by another process
+        total_size -= size
+
+def get_file_hash(path):
+    """Return the SHA-256 of a file's content, or None if it can't be read."""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def write_chunks_if_changed(path, chunks):
+    """Stream text or bytes chunks to a file, replacing it only if the content changed, so an unchanged file keeps its mtime.
+
+    Returns:
+        Tuple of (written, SHA-256 of the content)
+    """
+    digest = hashlib.sha256()
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                data = chunk if isinstance(chunk, bytes) else chunk.encode()
+                digest.update(data)
+                f.write(data)
+        
+        if os.path.exists(path) and filecmp.cmp(temp_path, path, shallow=False):
+            os.remove(temp_path)
+            return False, digest.hexdigest()
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True, digest.hexdigest()
+
+def convert_file(iterm_colors_path, output_paths, use_cache=True, cterm_colors=256, tuning_targets=()):
+    """Parse an iTerm2 colors file once and render it to every requested output.
+
+    Parsed colors and hashes of the rendered outputs are kept in the build
+    cache, so converting an unchanged file with the same converter doesn't
+    parse or render anything.
+
+    Args:
+        iterm_colors_path: Path of the iTerm2 colors file
+        output_paths: Dict of output targets (see RENDERERS) to output file
+            paths, or a single path for a Vim colorscheme
+        use_cache: Whether to use the build cache
+        cterm_colors: Number of terminal colors, see CTERM_COLORS
+        tuning_targets: Targets to tune derived color factors for, see
+            tune_derived_colors()
+
+    Returns:
+        Tuple of (colors, written), where written is a dict of output targets
+        to False if the output file already had the same content and was left
+        untouched
+    """
+    if isinstance(output_paths, str):
+        output_paths = {'vim': output_paths}
+    
+    theme_name = get_theme_name(iterm_colors_path)
+    with open(iterm_colors_path, 'rb') as f:
+        input_bytes = f.read()
+    
+    entry = None
+    if use_cache:
+        with profile_stage('cache'):
+            cache_dir = get_build_cache_dir()
+            cache_key = get_build_cache_key(input_bytes, theme_name, cterm_colors, tuning_targets)
+            entry = read_build_cache(cache_key, cache_dir)
+    
+    cache_changed = entry is None
+    if entry is None and tuning_targets:
+        base_colors = parse_base_colors(io.BytesIO(input_bytes))
+        with profile_stage('tuning'):
+            derived_colors, tuning = tune_derived_colors(base_colors, tuning_targets)
+        colors = build_palette(base_colors, compile_derived_colors(derived_colors, ITERM_TO_VIM_MAP.values()))
+        entry = {'colors': colors.to_dict(), 'tuning': tuning, 'outputs': {}}
+    elif entry is None:
+        colors = parse_iterm_colors(io.BytesIO(input_bytes))
+        entry = {'colors': colors.to_dict(), 'outputs': {}}
+    else:
+        colors = Palette.from_dict(entry['colors'], SEMANTIC_COLORS)
+    
+    written = {}
+    for target, output_path in output_paths.items():
+        # Don't even render if the output file has what we'd render
+        if target in entry['outputs'] and entry['outputs'][target] == get_file_hash(output_path):
+            written[target] = False
+            continue
+        
+        # Rendering is streamed into the file, time it separately from writing
+        _, _, render = RENDERERS[target]
+        chunks = profile_iter('rendering', render(colors, theme_name, cterm_colors))
+        with profile_stage('file write'):
+            written[target], output_hash = write_chunks_if_changed(output_path, chunks)
+        if entry['outputs'].get(target) != output_hash:
+            entry['outputs'][target] = output_hash
+            cache_changed = True
+    
+    if use_cache and cache_changed:
+        with profile_stage('cache'):
+            write_build_cache(cache_key, entry, cache_dir)
+    
+    return colors, written
+
+def get_output_paths(iterm_colors_path, targets, output_dir='.'):
+    """Return a dict of output targets to output file paths for an iTerm2 colors file."""
+    theme_name = get_theme_name(iterm_colors_path)
+    return {target: os.path.join(output_dir, RENDERERS[target][1](theme_name)) for target in targets}
+
+def find_iterm_colors_files(patterns):
+    """Expand files, directories and glob patterns into a sorted list of .itermcolors files."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(glob.glob(os.path.join(pattern, '*.itermcolors')))
+        elif os.path.exists(pattern):
+            paths.add(pattern)
+        else:
+            paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(paths)
+
+def _convert_file_job(job):
+    """Convert one file in a batch, returning an error message instead of raising."""
+    iterm_colors_path, output_paths, use_cache, cterm_colors, tuning_targets = job
+    try:
+        _, written = convert_file(iterm_colors_path, output_paths, use_cache, cterm_colors, tuning_targets)
+    except Exception as error:
+        return iterm_colors_path, output_paths, {}, f"{type(error).__name__}: {error}"
+    return iterm_colors_path, output_paths, written, None
+
+def batch_convert(patterns, output_dir='.', jobs=None, use_cache=True, targets=('vim',), cterm_colors=256,
+                  tuning_targets=()):
+    """Convert every iTerm2 colors file matched by the patterns using a process pool.
+
+    Args:
+        patterns: Files, directories or glob patterns
+        output_dir: Directory for the generated files
+        jobs: Number of worker processes, defaults to the number of CPUs
+        use_cache: Whether to use the build cache
+        targets: Output targets, see RENDERERS
+        cterm_colors: Number of terminal colors, see CTERM_COLORS
+        tuning_targets: Targets to tune derived color factors for, see
+            tune_derived_colors()
+
+    Returns:
+        List of (input path, output paths, written, error message or None)
+        tuples, see convert_file(). Files that would write the same output
+        file as another one are not converted and get an error.
+    """
+    paths = find_iterm_colors_files(patterns)
+    os.makedirs(output_dir, exist_ok=True)
+    all_output_paths = {path: get_output_paths(path, targets, output_dir) for path in paths}
+    
+    # Files with the same name in different directories would overwrite each
+    # other's output, so none of them are converted
+    owners = {}
+    for path, output_paths in all_output_paths.items():
+        for output_path in output_paths.values():
+            owners.setdefault(os.path.normcase(os.path.abspath(output_path)), (output_path, []))[1].append(path)
+    errors = {}
+    for output_path, owner_paths in owners.values():
+        if len(owner_paths) > 1:
+            for path in owner_paths:
+                others = ', '.join(f"'{other}'" for other in owner_paths if other != path)
+                errors.setdefault(path, f"Output file '{output_path}' would also be written by {others}")
+    
+    job_list = [(path, output_paths, use_cache, cterm_colors, tuning_targets)
+                for path, output_paths in all_output_paths.items() if path not in errors]
+    
+    # Spinning up a pool isn't worth it for a single file or worker
+    if jobs == 1 or len(job_list) <= 1:
+        converted = [_convert_file_job(job) for job in job_list]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            converted = list(executor.map(_convert_file_job, job_list))
+    
+    results = {result[0]: result for result in converted}
+    results.update((path, (path, all_output_paths[path], {}, error)) for path, error in errors.items())
+    return [results[path] for path in paths]
+
+def print_batch_report(results, elapsed):
+    """Print a summary of a batch conversion."""
+    failed = [result for result in results if result[3] is not None]
+    for iterm_colors_path, output_paths, written, error in results:
+        if error is not None:
+            print(f"failed     {iterm_colors_path}: {error}")
+            continue
+        status = "written" if any(written.values()) else "unchanged"
+        print(f"{status:<11}{iterm_colors_path} -> {', '.join(output_paths.values())}")
+    print(f"\nConverted {len(results) - len(failed)} of {len(results)} files in {elapsed:.2f}s", end='')
+    print(f", {len(failed)} failed" if failed else "")
+
+# Number of results a Converter keeps by default
+CONVERTER_CACHE_SIZE = 128
+
+class Converter:
+    """Reusable converter for long-running services, safe to share between threads.
+    
+    Takes iTerm2 colors as bytes or binary file objects instead of paths.
+    Tables that are otherwise built on first use, like the xterm palette, are
+    prepared when the converter is created. Parsed palettes and rendered
+    outputs are kept in a bounded LRU cache keyed by a hash of the input,
+    with hit and miss counters in cache_info().
+    """
+    
+    def __init__(self, cterm_colors=256, cache_size=CONVERTER_CACHE_SIZE):
+        """
+        Args:
+            cterm_colors: Number of terminal colors, see CTERM_COLORS
+            cache_size: Number of parsed palettes and rendered outputs to
+                keep, 0 disables the cache
+        """
+        if cache_size < 0:
+            raise ValueError("Cache size can't be negative")
+        get_xterm_palette(cterm_colors)
+        self.cterm_colors = cterm_colors
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+    
+    def _read(self, source):
+        """Return the content of bytes or a binary file object."""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return bytes(source)
+        data = source.read() if hasattr(source, 'read') else None
+        if not isinstance(data, bytes):
+            raise TypeError(f"Expected bytes or a binary file object, got {type(source).__name__}")
+        return data
+    
+    def _get(self, key):
+        """Return a cached result or None, marking it as recently used."""
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._cache.move_to_end(key)
+            return value
+    
+    def _put(self, key, value):
+        """Cache a result, evicting the least recently used ones over the size limit."""
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _parse(self, data):
+        """Return the hash of iTerm2 colors and their cached palette, parsing them if needed."""
+        digest = hashlib.sha256(data).hexdigest()
+        colors = self._get(('palette', digest))
+        if colors is None:
+            colors = parse_iterm_colors(io.BytesIO(data))
+            self._put(('palette', digest), colors)
+        return digest, colors
+    
+    def parse(self, source):
+        """Parse iTerm2 colors from bytes or a binary file object into a Palette, see parse_iterm_colors()."""
+        # The cached palette is shared, callers may change theirs
+        return self._parse(self._read(source))[1].copy()
+    
+    def render(self, source, theme_name, target='vim'):
+        """Convert iTerm2 colors from bytes or a binary file object to one of the RENDERERS targets.
+    
+        Returns:
+            Rendered output, bytes for the palette target and a string for
+            the others
+        """
+        if target not in RENDERERS:
+            raise ValueError(f"Target must be one of {tuple(RENDERERS)}, got '{target}'")
+        digest, colors = self._parse(self._read(source))
+        key = ('render', digest, theme_name, target)
+        output = self._get(key)
+        if output is None:
+            chunks = list(RENDERERS[target][2](colors, theme_name, self.cterm_colors))
+            output = b''.join(chunks) if chunks and isinstance(chunks[0], bytes) else ''.join(chunks)
+            self._put(key, output)
+        return output
+    
+    def cache_info(self):
+        """Return a dict with the number of cache hits and misses, and the current and maximum cache size."""
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._cache),
+                    'max_size': self.cache_size}
+    
+    def clear_cache(self):
+        """Remove all cached results and reset the counters."""
+        with self._lock:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+
+# Seconds between checks for changed files in watch mode
+WATCH_INTERVAL = 0.25
+
+# Seconds a changed file has to stay unchanged before it's converted, so a
+# burst of saves triggers a single conversion
+WATCH_DEBOUNCE = 0.3
+
+def get_file_signature(path):
+    """Return (mtime, size) of a file, or None if it can't be read."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def render_outputs(colors, theme_name, output_paths, cterm_colors=256):
+    """Render a palette to every output file, returning a dict of output targets to whether the file was written."""
+    written = {}
+    for target, output_path in output_paths.items():
+        _, _, render = RENDERERS[target]
+        written[target], _ = write_chunks_if_changed(output_path, render(colors, theme_name, cterm_colors))
+    return written
+
+def update_watched_file(iterm_colors_path, output_paths, palettes, cterm_colors=256):
+    """Convert a changed file in watch mode and print what happened.
+
+    The previous palette of the file, if any, is updated in place in palettes,
+    so only the colors affected by the change are recalculated, and nothing
+    is rendered if no color changed.
+    """
+    timestamp = time.strftime('%H:%M:%S')
+    try:
+        base_colors = parse_base_colors(iterm_colors_path)
+        if iterm_colors_path in palettes:
+            colors, changed = update_palette(palettes[iterm_colors_path], base_colors)
+        else:
+            colors = build_palette(base_colors)
+            changed = set(colors)
+        
+        written = {}
+        if changed:
+            written = render_outputs(colors, get_theme_name(iterm_colors_path), output_paths, cterm_colors)
+    except (ET.ParseError, OSError, ValueError) as error:
+        # Usually a file caught in the middle of being saved, it'll be retried on the next change
+        print(f"{timestamp} failed     {iterm_colors_path}: {type(error).__name__}: {error}")
+        return
     
-    iterm_colors_path = sys.argv[1]
+    palettes[iterm_colors_path] = colors
+    status = "written" if any(written.values()) else "unchanged"
+    print(f"{timestamp} {status:<11}{iterm_colors_path} -> {', '.join(output_paths.values())} "
+          f"({len(changed)} colors changed)")
+
+def watch(patterns, output_dir='.', targets=('vim',), cterm_colors=256, interval=WATCH_INTERVAL,
+          debounce=WATCH_DEBOUNCE):
+    """Convert iTerm2 colors files whenever they change, until interrupted.
+
+    Files are polled for changes of their modification time or size. Files
+    matching the patterns that appear later are picked up as well.
+
+    Args:
+        patterns: Files, directories or glob patterns
+        output_dir: Directory for the generated files
+        targets: Output targets, see RENDERERS
+        cterm_colors: Number of terminal colors, see CTERM_COLORS
+        interval: Seconds between checks for changes
+        debounce: Seconds a changed file has to stay unchanged before it's
+            converted
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    palettes = {}
+    signatures = {}
+    # Files changed since their last conversion, with the time of the change
+    pending = {}
+    first_scan = True
+    while True:
+        now = time.monotonic()
+        for path in find_iterm_colors_files(patterns):
+            signature = get_file_signature(path)
+            if signature is not None and signature != signatures.get(path):
+                signatures[path] = signature
+                # Convert right away on start
+                pending[path] = now - debounce if first_scan else now
+        first_scan = False
+        
+        for path, changed_at in list(pending.items()):
+            if now - changed_at < debounce:
+                continue
+            del pending[path]
+            update_watched_file(path, get_output_paths(path, targets, output_dir), palettes, cterm_colors)
+        
+        time.sleep(interval)
+
+def parse_tuning_target_arg(value):
+    """Parse a --tune argument, see parse_tuning_target()."""
+    try:
+        return parse_tuning_target(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Convert iTerm2 color schemes to Vim colorschemes.",
+        usage="%(prog)s <iterm_colors_file> [output_vim_file]\n"
+              "       %(prog)s <iterm_colors_file> --target TARGET... [--output-dir DIR]\n"
+              "       %(prog)s --batch <file|directory|glob>... [--output-dir DIR] [--jobs N]\n"
+              "       %(prog)s --watch <file|directory|glob>... [--output-dir DIR]",
+    )
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help="iTerm2 colors file and optional output file, or inputs in batch mode")
+    parser.add_argument('--batch', action='store_true',
+                        help="convert every .itermcolors file matched by the given files, directories or globs")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and convert the given files, directories or globs whenever they change")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="output directory (default: current directory)")
+    parser.add_argument('-t', '--target', dest='targets', action='append', choices=RENDERERS,
+                        help="output to generate, can be repeated to render several outputs "
+                             "from a single parse (default: vim)")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of worker processes in batch mode (default: number of CPUs)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="always regenerate output instead of using the build cache")
+    parser.add_argument('--compiled', action='store_true',
+                        help="write flat highlight commands instead of building them when Vim loads "
+                             "the colorscheme, same as --target vim-compiled")
+    parser.add_argument('--cterm-colors', type=int, choices=CTERM_COLORS, default=256,
+                        help="terminal palette for cterm colors: the xterm color cube and grays (256) "
+                             "or the 16 ANSI colors (default: 256)")
+    parser.add_argument('--profile', action='store_true',
+                        help="report wall time, CPU time and peak memory of every conversion stage to stderr "
+                             "(batch mode then converts in a single process)")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="write the --profile report to a JSON file instead of stderr")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="run under cProfile, save the stats to FILE and print the hottest functions to stderr")
+    parser.add_argument('--min-contrast', type=float, metavar='VALUE',
+                        help="fail if the text and background of a highlight group have less contrast, "
+                             "a WCAG ratio or an absolute APCA Lc (default: report only)")
+    parser.add_argument('--contrast-method', choices=CONTRAST_METHODS, default='wcag',
+                        help="contrast metric for --min-contrast and --contrast-report (default: wcag)")
+    parser.add_argument('--tune', dest='tuning_targets', action='append', type=parse_tuning_target_arg,
+                        default=[], metavar='METRIC:COLOR:OTHER:MIN',
+                        help="solve for the factor of a derived color so it reaches a contrast ratio or "
+                             "Delta E against another color, like contrast:comment:bg:4.5 or "
+                             "delta_e:*_contrast::10 (empty OTHER is the base color), can be repeated")
+    parser.add_argument('--contrast-report', metavar='FILE',
+                        help="save the contrast matrix of the palette to a .csv file, or the matrix and "
+                             "highlight group contrast to a .json file")
+    # Allow options between paths, like `theme.itermcolors --compiled out.vim`
+    args = parser.parse_intermixed_args(argv)
+    if args.batch and args.watch:
+        parser.error("--batch and --watch can't be combined, --watch takes several inputs too")
+    if not (args.batch or args.watch) and len(args.paths) > 2:
+        parser.error("expected an iTerm colors file and an optional output file, use --batch for more")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if (args.batch or args.watch) and (args.min_contrast is not None or args.contrast_report):
+        parser.error("--min-contrast and --contrast-report only work with a single iTerm colors file")
+    if args.watch and args.tuning_targets:
+        parser.error("--tune doesn't work with --watch")
+    if args.contrast_report and not args.contrast_report.lower().endswith(('.csv', '.json')):
+        parser.error("--contrast-report must be a .csv or .json file")
+    if args.profile_output:
+        args.profile = True
+    # Stages running in worker processes can't be profiled
+    if (args.profile or args.cprofile) and args.batch:
+        args.jobs = 1
+    
+    targets = list(dict.fromkeys(args.targets or ['vim']))
+    if args.compiled:
+        if 'vim' not in targets and 'vim-compiled' not in targets:
+            parser.error("--compiled only applies to the vim target, use --target vim-compiled")
+        targets = list(dict.fromkeys('vim-compiled' if target == 'vim' else target for target in targets))
+    if 'vim' in targets and 'vim-compiled' in targets:
+        parser.error("vim and vim-compiled targets write the same file, choose one")
+    if not (args.batch or args.watch) and len(args.paths) == 2 and len(targets) > 1:
+        parser.error("an output file can only be given for a single target, use --output-dir")
+    args.targets = targets
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    if not (args.profile or args.cprofile):
+        convert(args)
+        return
+    
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile() if args.cprofile else None
+    if args.profile:
+        start_profiling()
+    if profiler:
+        profiler.enable()
+    try:
+        convert(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"\ncProfile stats saved to '{args.cprofile}', hottest functions:", file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+        if args.profile:
+            stages = stop_profiling()
+            if args.profile_output:
+                with open(args.profile_output, 'w') as f:
+                    json.dump({'stages': stages}, f, indent=2)
+                    f.write('\n')
+            else:
+                print(f"\n{format_profile(stages)}", end='', file=sys.stderr)
+
+def convert(args):
+    """Run the conversion described by the command line arguments."""
+    if args.watch:
+        print(f"Watching {', '.join(args.paths)} for changes, press Ctrl+C to stop")
+        try:
+            watch(args.paths, args.output_dir, args.targets, args.cterm_colors)
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+        return
+    
+    if args.batch:
+        start = time.perf_counter()
+        results = batch_convert(args.paths, args.output_dir, args.jobs, args.use_cache, args.targets,
+                                args.cterm_colors, args.tuning_targets)
+        if not results:
+            print("Error: no iTerm colors files found.")
+            sys.exit(1)
+        print_batch_report(results, time.perf_counter() - start)
+        if any(error is not None for _, _, _, error in results):
+            sys.exit(1)
+        return
+    
+    iterm_colors_path = args.paths[0]
     
     if not os.path.exists(iterm_colors_path):
         print(f"Error: iTerm colors file '{iterm_colors_path}' not found.")
         sys.exit(1)
     
-    # Get the theme name from the file name
-    theme_name = os.path.splitext(os.path.basename(iterm_colors_path))[0]
-    
-    # Set output file path
-    if len(sys.argv) >= 3:
-        output_path = sys.argv[2]
+    # Set output file paths
+    if len(args.paths) >= 2:
+        output_paths = {args.targets[0]: args.paths[1]}
     else:
-        output_path = f"{theme_name.lower().replace(' ', '_')}.vim"
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_paths = get_output_paths(iterm_colors_path, args.targets, args.output_dir)
     
-    # Parse iTerm colors and generate Vim colorscheme
-    colors = parse_iterm_colors(iterm_colors_path)
-    vim_colorscheme = generate_vim_colorscheme(colors, theme_name)
+    try:
+        colors, written = convert_file(iterm_colors_path, output_paths, args.use_cache, args.cterm_colors,
+                                       args.tuning_targets)
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
     
-    # Save the Vim colorscheme
-    with open(output_path, 'w') as f:
-        f.write(vim_colorscheme)
+    for target, output_path in output_paths.items():
+        description = RENDERERS[target][0]
+        if written[target]:
+            print(f"{description} saved to '{output_path}'")
+        else:
+            print(f"{description} '{output_path}' is up to date")
     
-    print(f"Vim colorscheme saved to '{output_path}'")
+    if args.min_contrast is not None or args.contrast_report:
+        check_contrast(colors, args)
     
     # Print some example colors for reference
     print("\nExample color conversions:")
@@ -530,5 +2691,22 @@ def main():
     if 'green' in colors:
         print(f"green: {colors['green']}")
 
+def check_contrast(colors, args):
+    """Report highlight groups with low contrast, and exit with an error if --min-contrast is set."""
+    report = get_contrast_report(colors, args.contrast_method, args.min_contrast, args.use_cache)
+    if args.contrast_report:
+        write_contrast_report(args.contrast_report, report)
+        print(f"Contrast report saved to '{args.contrast_report}'")
+    
+    failed = [group for group in report['groups'] if not group['passed']]
+    for group in failed:
+        print(f"Low contrast: {group['group']} ({group['fg']} on {group['bg']}) is "
+              f"{group['contrast']:.2f}, expected at least {report['min_contrast']:g}")
+    if failed and args.min_contrast is not None:
+        sys.exit(1)
+
+# Taken once all module-level tables are built, see _IMPORT_STARTED
+_IMPORT_FINISHED = (time.perf_counter(), time.process_time())
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,130 @@
+"""Generate variants of a theme over a grid of derived color factors and contrast levels.
+
+Usage: python generate_variants.py <iterm_colors_file> [--factor NAME=F,F...]... [--contrast C,C...] [--output-dir DIR]
+
+Every combination of the given factors and contrast levels becomes a variant.
+Factors replace the ones in DERIVED_COLORS, either a single factor like
+gray08=0.5,0.55 or per-channel factors like bright_pink=1:0.7:0.8. Contrast
+levels scale how far every factor is from 1. All variants are derived at once
+as a single array and rendered with the converter's Vim renderer, one
+colorscheme per variant, plus a variants.json file describing them.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from convert_iterm2_to_vim import (
+    CTERM_COLORS,
+    RENDERERS,
+    get_theme_name,
+    iter_variant_palettes,
+    parse_iterm_colors,
+    write_chunks_if_changed,
+)
+
+def parse_factor(value):
+    """Parse NAME=F,F... into (name, list of factors), where a factor is a number or r:g:b."""
+    name, separator, factors = value.partition('=')
+    if not separator or not name or not factors:
+        raise argparse.ArgumentTypeError(f"expected NAME=FACTOR[,FACTOR...], got '{value}'")
+    try:
+        return name, [tuple(float(part) for part in factor.split(':')) if ':' in factor else float(factor)
+                      for factor in factors.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid factor in '{value}'")
+
+def parse_contrast(value):
+    """Parse a comma-separated list of contrast levels."""
+    try:
+        return [float(level) for level in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid contrast levels '{value}'")
+
+def get_variants(factor_grid, contrast_levels):
+    """Return a variant for every combination of factors and contrast levels, see get_variant_factors().
+
+    Args:
+        factor_grid: List of (derived color name, list of factors)
+        contrast_levels: List of contrast levels
+    """
+    names = [name for name, _ in factor_grid]
+    return [
+        {'contrast': contrast, 'factors': dict(zip(names, factors))}
+        for contrast in contrast_levels
+        for factors in itertools.product(*(values for _, values in factor_grid))
+    ]
+
+def generate_variants(iterm_colors_path, variants, output_dir='.', target='vim', cterm_colors=256):
+    """Render a colorscheme for every variant of a theme.
+
+    Returns:
+        List of (variant theme name, output path, written) tuples
+    """
+    colors = parse_iterm_colors(iterm_colors_path)
+    theme_name = get_theme_name(iterm_colors_path)
+    _, get_file_name, render = RENDERERS[target]
+    width = len(str(len(variants)))
+    results = []
+    for index, palette in enumerate(iter_variant_palettes(colors, variants), 1):
+        variant_name = f"{theme_name} Variant {index:0{width}}"
+        output_path = os.path.join(output_dir, get_file_name(variant_name))
+        written, _ = write_chunks_if_changed(output_path, render(palette, variant_name, cterm_colors))
+        results.append((variant_name, output_path, written))
+    return results
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate Vim colorscheme variants over a grid of "
+                                                 "derived color factors and contrast levels.")
+    parser.add_argument('iterm_colors_file', help="iTerm2 colors file")
+    parser.add_argument('--factor', dest='factors', action='append', type=parse_factor, default=[],
+                        metavar='NAME=F,F...',
+                        help="factors to try for a derived color, a number or r:g:b, can be repeated")
+    parser.add_argument('--contrast', type=parse_contrast, default=[1.0], metavar='C,C...',
+                        help="contrast levels to try, 1 keeps the factors as they are (default: 1)")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="output directory (default: current directory)")
+    parser.add_argument('--compiled', action='store_true',
+                        help="write flat highlight commands, see the converter's --compiled")
+    parser.add_argument('--cterm-colors', type=int, choices=CTERM_COLORS, default=256,
+                        help="terminal palette for cterm colors (default: 256)")
+    args = parser.parse_args(argv)
+    names = [name for name, _ in args.factors]
+    if len(names) != len(set(names)):
+        parser.error("every color can only have one --factor")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.iterm_colors_file):
+        print(f"Error: iTerm colors file '{args.iterm_colors_file}' not found.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    variants = get_variants(args.factors, args.contrast)
+    os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        results = generate_variants(args.iterm_colors_file, variants, args.output_dir,
+                                    'vim-compiled' if args.compiled else 'vim', args.cterm_colors)
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+
+    manifest_path = os.path.join(args.output_dir, 'variants.json')
+    with open(manifest_path, 'w') as f:
+        json.dump([
+            {'name': name, 'file': os.path.basename(path), **variant}
+            for (name, path, _), variant in zip(results, variants)
+        ], f, indent=2)
+        f.write('\n')
+
+    written = sum(1 for _, _, was_written in results if was_written)
+    print(f"Generated {len(results)} variants in {time.perf_counter() - start:.2f}s, "
+          f"{written} written, {len(results) - written} unchanged")
+    print(f"Variants described in '{manifest_path}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""Preview a theme on the files in sample/ as 24-bit ANSI in the terminal or as an HTML page.
+
+Usage: python preview_samples.py [paths...] [--palette FILE] [--html FILE] [--jobs N] [--no-cache]
+
+Colors come from the iTerm2 theme through parse_iterm_colors(), and tokens get
+the colors of the same highlight groups as in the generated Vim colorscheme.
+Samples are tokenized with Pygments in a process pool, and tokens are cached
+by file content and lexer in the size-limited build cache, so previewing
+again after changing the palette only colors the cached tokens.
+"""
+import argparse
+import hashlib
+import html
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from convert_iterm2_to_vim import (
+    DEFAULT_THEME_PATH,
+    HIGHLIGHT_GROUPS,
+    REGULAR_MODE_HIGHLIGHT_GROUPS,
+    get_cache_dir,
+    get_theme_name,
+    parse_iterm_colors,
+    read_build_cache,
+    write_build_cache,
+)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Directory previewed by default
+SAMPLE_DIR = os.path.join(ROOT, 'sample')
+
+# Bump when tokens are stored differently, to invalidate cached ones
+TOKEN_CACHE_VERSION = 2
+
+# Size limit of the token cache, least recently used entries are evicted past it
+TOKEN_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Vim highlight groups of Pygments token types. Tokens without a group of their
+# own use the group of their closest parent type, or Normal.
+TOKEN_GROUPS = {
+    'Comment': 'Comment',
+    'Comment.Preproc': 'PreProc',
+    'Comment.PreprocFile': 'String',
+    'Comment.Special': 'SpecialComment',
+    'Keyword': 'Keyword',
+    'Keyword.Constant': 'Boolean',
+    'Keyword.Declaration': 'StorageClass',
+    'Keyword.Namespace': 'Include',
+    'Keyword.Type': 'Type',
+    'Name.Attribute': 'Identifier',
+    'Name.Builtin': 'Identifier',
+    'Name.Class': 'Type',
+    'Name.Decorator': 'PreProc',
+    'Name.Exception': 'Exception',
+    'Name.Function': 'Function',
+    'Name.Label': 'Label',
+    'Name.Namespace': 'Type',
+    'Name.Tag': 'Tag',
+    'Literal.String': 'String',
+    'Literal.String.Char': 'Character',
+    'Literal.String.Escape': 'SpecialChar',
+    'Literal.String.Regex': 'Special',
+    'Literal.Number': 'Number',
+    'Literal.Number.Float': 'Float',
+    'Operator': 'Operator',
+    'Operator.Word': 'Keyword',
+    'Punctuation': 'Delimiter',
+    'Generic.Heading': 'Title',
+    'Generic.Subheading': 'Title',
+    'Generic.Inserted': 'Green',
+    'Generic.Deleted': 'Red',
+    'Generic.Error': 'Error',
+    'Error': 'Error',
+}
+
+# Lexers for sample files Pygments doesn't recognize by name
+LEXER_FALLBACKS = {
+    '.astro': 'html',
+    '.mdx': 'markdown',
+}
+
+def get_token_group(token_type):
+    """Return the highlight group of a Pygments token type name like 'Token.Literal.String.Double'."""
+    name = token_type[len('Token.'):] if token_type.startswith('Token.') else ''
+    while name:
+        if name in TOKEN_GROUPS:
+            return TOKEN_GROUPS[name]
+        name = name.rpartition('.')[0]
+    return 'Normal'
+
+def get_sample_lexer(path):
+    """Return the Pygments lexer for a sample file, picked by its file name."""
+    from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+    from pygments.util import ClassNotFound
+
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension in LEXER_FALLBACKS:
+            return get_lexer_by_name(LEXER_FALLBACKS[extension])
+        return get_lexer_for_filename(path)
+    except ClassNotFound:
+        return get_lexer_by_name('text')
+
+def tokenize_sample(job):
+    """Tokenize a sample file with Pygments.
+
+    Returns:
+        List of [highlight group, text] pairs, with neighboring tokens of the
+        same group merged
+    """
+    path, data = job
+    lexer = get_sample_lexer(path)
+    tokens = []
+    for token_type, text in lexer.get_tokens(data.decode('utf-8', errors='replace')):
+        group = get_token_group(str(token_type))
+        if tokens and tokens[-1][0] == group:
+            tokens[-1][1] += text
+        else:
+            tokens.append([group, text])
+    return tokens
+
+def get_token_cache_key(path, data):
+    """Hash everything tokens depend on: file content, lexer, token groups and Pygments version."""
+    import pygments
+    lexer = get_sample_lexer(path)
+    digest = hashlib.sha256(f'tokens\0{TOKEN_CACHE_VERSION}\0{pygments.__version__}\0'.encode())
+    # The file name picks the lexer, so files with the same extension can still differ
+    digest.update(f'{type(lexer).__module__}.{type(lexer).__name__}\0'.encode())
+    digest.update(json.dumps(TOKEN_GROUPS).encode())
+    digest.update(data)
+    return digest.hexdigest()
+
+def find_samples(paths):
+    """Expand files and directories (without subdirectories) into a sorted list of sample files."""
+    samples = set()
+    for path in paths:
+        if os.path.isdir(path):
+            samples.update(entry.path for entry in os.scandir(path) if entry.is_file())
+        elif os.path.isfile(path):
+            samples.add(path)
+    return sorted(samples)
+
+def tokenize_samples(paths, jobs=None, use_cache=True):
+    """Tokenize sample files, in a process pool for the ones that aren't in the token cache.
+
+    Returns:
+        Tuple of (list of (path, tokens), number of files tokenized)
+    """
+    cache_dir = os.path.join(get_cache_dir(), 'tokens')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tokens = {}
+    missing = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = get_token_cache_key(path, data)
+        cached = read_build_cache(key, cache_dir) if use_cache else None
+        if cached is not None:
+            tokens[path] = cached
+        else:
+            missing.append((path, data, key))
+
+    job_list = [(path, data) for path, data, _ in missing]
+    if jobs == 1 or len(job_list) <= 1:
+        results = [tokenize_sample(job) for job in job_list]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(tokenize_sample, job_list))
+
+    for (path, _, key), sample_tokens in zip(missing, results):
+        tokens[path] = sample_tokens
+        write_build_cache(key, sample_tokens, cache_dir, TOKEN_CACHE_MAX_BYTES)
+
+    return [(path, tokens[path]) for path in paths], len(missing)
+
+def get_group_styles(colors):
+    """Return a dict of highlight groups to (fg RGB, bg RGB, list of styles) for a palette.
+
+    Like in Vim, groups without a color, or with 'none' text, show the Normal one.
+    """
+    groups = {group: spec for _, mode_groups in HIGHLIGHT_GROUPS for group, spec in mode_groups.items()}
+    groups.update(REGULAR_MODE_HIGHLIGHT_GROUPS)
+    normal = groups['Normal']
+    styles = {}
+    for group, spec in groups.items():
+        fg = spec.get('fg', 'none')
+        fg = colors.get_rgb(normal['fg'] if fg == 'none' else fg) or colors.get_rgb(normal['fg'])
+        bg = colors.get_rgb(spec.get('bg', normal['bg'])) or colors.get_rgb(normal['bg'])
+        styles[group] = (fg, bg, spec['style'].split(',') if 'style' in spec else [])
+    return styles
+
+# SGR codes of Vim styles
+ANSI_STYLES = {'bold': '1', 'italic': '3', 'underline': '4', 'reverse': '7'}
+
+def iter_ansi_preview(path, tokens, styles):
+    """Yield a sample colored with 24-bit ANSI escape codes, chunk by chunk."""
+    codes = {}
+    for group, (fg, bg, group_styles) in styles.items():
+        sgr = ['0', '38;2;{};{};{}'.format(*fg), '48;2;{};{};{}'.format(*bg)]
+        sgr.extend(ANSI_STYLES[style] for style in group_styles if style in ANSI_STYLES)
+        codes[group] = f"\x1b[{';'.join(sgr)}m"
+
+    yield f"{codes['Title']}{os.path.basename(path)}\x1b[K\n{codes['Normal']}\x1b[K\n"
+    for group, text in tokens:
+        # Clearing to the end of line fills it with the current background
+        yield codes.get(group, codes['Normal']) + text.replace('\n', '\x1b[K\n')
+    yield "\x1b[0m\n"
+
+def format_css_rgb(rgb):
+    """Format an 8-bit RGB tuple as a CSS hex color."""
+    return '#' + bytes(rgb).hex()
+
+# CSS declarations of Vim styles
+CSS_STYLES = {
+    'bold': 'font-weight: bold',
+    'italic': 'font-style: italic',
+    'underline': 'text-decoration: underline',
+}
+
+def iter_html_preview(samples, styles, title):
+    """Yield an HTML page with every sample, chunk by chunk.
+
+    Args:
+        samples: List of (path, tokens) from tokenize_samples()
+        styles: Group styles from get_group_styles()
+        title: Page title
+    """
+    css = {}
+    for group, (fg, bg, group_styles) in styles.items():
+        declarations = [f'color: {format_css_rgb(fg)}']
+        if bg != styles['Normal'][1]:
+            declarations.append(f'background: {format_css_rgb(bg)}')
+        declarations.extend(CSS_STYLES[style] for style in group_styles if style in CSS_STYLES)
+        css[group] = '; '.join(declarations)
+
+    fg, bg, _ = styles['Normal']
+    yield (f'<!doctype html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{html.escape(title)}</title>\n'
+           f'<style>body {{ color: {format_css_rgb(fg)}; background: {format_css_rgb(bg)}; '
+           f'font-family: monospace; }}</style>\n</head>\n<body>\n')
+    for path, tokens in samples:
+        yield f'<h2 style="{css["Title"]}">{html.escape(os.path.basename(path))}</h2>\n<pre>'
+        for group, text in tokens:
+            if group == 'Normal':
+                yield html.escape(text)
+            else:
+                yield f'<span style="{css.get(group, css["Normal"])}">{html.escape(text)}</span>'
+        yield '</pre>\n'
+    yield '</body>\n</html>\n'
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Preview a theme on sample files as 24-bit ANSI or HTML.")
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help="sample files or directories (default: sample/)")
+    parser.add_argument('--palette', default=DEFAULT_THEME_PATH, metavar='FILE',
+                        help="iTerm2 colors file to take the colors from (default: the Squirrelsong Dark "
+                             "iTerm2 theme)")
+    parser.add_argument('--html', metavar='FILE', help="write an HTML page instead of printing to the terminal")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of worker processes for tokenizing (default: number of CPUs)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="always tokenize instead of using cached tokens")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        import pygments
+    except ImportError:
+        print("Error: previews need Pygments, install it with `pip install pygments`.")
+        sys.exit(1)
+    if not os.path.exists(args.palette):
+        print(f"Error: iTerm colors file '{args.palette}' not found.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    paths = find_samples(args.paths or [SAMPLE_DIR])
+    if not paths:
+        print("Error: no sample files found.")
+        sys.exit(1)
+    samples, tokenized = tokenize_samples(paths, args.jobs, args.use_cache)
+    styles = get_group_styles(parse_iterm_colors(args.palette))
+
+    if args.html:
+        with open(args.html, 'w') as f:
+            f.writelines(iter_html_preview(samples, styles, get_theme_name(args.palette)))
+    else:
+        for path, tokens in samples:
+            sys.stdout.writelines(iter_ansi_preview(path, tokens, styles))
+
+    print(f"Previewed {len(samples)} samples in {time.perf_counter() - start:.2f}s, "
+          f"{tokenized} tokenized, {len(samples) - tokenized} from cache", file=sys.stderr)
+    if args.html:
+        print(f"Preview saved to '{args.html}'", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
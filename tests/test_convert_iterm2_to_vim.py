@@ -0,0 +1,353 @@
+"""Tests for convert_iterm2_to_vim.py."""
+import os
+import plistlib
+import random
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import convert_iterm2_to_vim  # noqa: E402
+from convert_iterm2_to_vim import (  # noqa: E402
+    DERIVED_COLORS,
+    ITERM_TO_VIM_MAP,
+    PALETTE_HEADER,
+    RENDERERS,
+    Palette,
+    batch_convert,
+    build_palette,
+    compile_derived_colors,
+    convert_color,
+    convert_colors,
+    derive_colors,
+    generate_compiled_vim_colorscheme,
+    generate_vim_colorscheme,
+    get_build_cache_key,
+    get_contrast_report,
+    load_palette_array,
+    lut_convert_colors,
+    parse_args,
+    parse_base_colors,
+    parse_iterm_colors,
+    read_palette_file,
+    to_hex,
+    to_rgb8,
+    update_palette,
+)
+
+THEME_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'themes', 'iTerm2', 'Squirrelsong Dark.itermcolors')
+THEME_NAME = 'Squirrelsong Dark'
+
+@pytest.fixture(scope='module')
+def colors():
+    return parse_iterm_colors(THEME_PATH)
+
+def get_highlight_group_names(vim_script):
+    """Return the names of the highlight groups defined by a generated colorscheme."""
+    # Dynamic colorschemes list groups as dict entries, compiled ones as highlight commands
+    names = set(re.findall(r"^\s*\\ '(\w+)':\s*\{", vim_script, re.MULTILINE))
+    names.update(re.findall(r"^\s*highlight (?!clear\b)(\w+) ", vim_script, re.MULTILINE))
+    return names
+
+def get_vim_highlights(script_path, diff, color_only, tmp_path):
+    """Source a colorscheme in Vim and return a dict of highlight group names to their attributes."""
+    output_path = tmp_path / 'highlights.txt'
+    commands = [
+        f"let g:squirrelsong_color_only = {'v:true' if color_only else 'v:false'}",
+        'set diff' if diff else 'set nodiff',
+        f'source {script_path}',
+        f'redir! > {output_path}',
+        'silent highlight',
+        'redir END',
+        'qa!',
+    ]
+    args = ['vim', '-Nu', 'NONE', '-i', 'NONE', '-es']
+    for command in commands:
+        args.extend(['-c', command])
+    subprocess.run(args, check=True, timeout=30)
+
+    # Long highlights continue on indented lines
+    listing = re.sub(r'\n\s+(?=\S)', ' ', output_path.read_text())
+    highlights = {}
+    for line in listing.splitlines():
+        match = re.match(r'(\w+)\s+xxx\s+(.*)', line)
+        if match:
+            highlights[match.group(1)] = match.group(2).split()
+    return highlights
+
+def test_compiled_colorscheme_defines_same_groups(colors):
+    dynamic = get_highlight_group_names(generate_vim_colorscheme(colors, THEME_NAME))
+    compiled = get_highlight_group_names(generate_compiled_vim_colorscheme(colors, THEME_NAME))
+    assert dynamic == compiled
+
+@pytest.mark.skipif(shutil.which('vim') is None, reason="needs Vim")
+@pytest.mark.parametrize('diff', [False, True])
+@pytest.mark.parametrize('color_only', [False, True])
+def test_compiled_colorscheme_matches_dynamic_in_vim(colors, diff, color_only, tmp_path):
+    dynamic_path = tmp_path / 'dynamic.vim'
+    compiled_path = tmp_path / 'compiled.vim'
+    dynamic_path.write_text(generate_vim_colorscheme(colors, THEME_NAME))
+    compiled_path.write_text(generate_compiled_vim_colorscheme(colors, THEME_NAME))
+
+    dynamic = get_vim_highlights(dynamic_path, diff, color_only, tmp_path)
+    compiled = get_vim_highlights(compiled_path, diff, color_only, tmp_path)
+    assert dynamic['Normal'] == compiled['Normal'] != ['cleared']
+    assert dynamic == compiled
+
+@pytest.mark.parametrize('table', ['DIFF_MODE_HIGHLIGHT_GROUPS', 'REGULAR_MODE_HIGHLIGHT_GROUPS'])
+def test_build_cache_key_depends_on_highlight_groups(table, monkeypatch):
+    key = get_build_cache_key(b'theme', THEME_NAME)
+    monkeypatch.setitem(getattr(convert_iterm2_to_vim, table), 'CursorLine', {'style': 'reverse'})
+    assert get_build_cache_key(b'theme', THEME_NAME) != key
+
+def test_build_cache_key_depends_on_highlight_group_table(monkeypatch):
+    key = get_build_cache_key(b'theme', THEME_NAME)
+    (title, groups), *rest = convert_iterm2_to_vim.HIGHLIGHT_GROUPS
+    monkeypatch.setattr(convert_iterm2_to_vim, 'HIGHLIGHT_GROUPS', [(title, {**groups, 'Normal': {'fg': 'red'}}), *rest])
+    assert get_build_cache_key(b'theme', THEME_NAME) != key
+
+def test_parse_args_allows_options_between_paths():
+    args = parse_args(['theme.itermcolors', '--compiled', 'out.vim'])
+    assert args.paths == ['theme.itermcolors', 'out.vim']
+    assert args.targets == ['vim-compiled']
+
+def test_parse_args_rejects_compiled_without_vim_target():
+    with pytest.raises(SystemExit):
+        parse_args(['a.itermcolors', '-t', 'lua', '--compiled'])
+
+@pytest.mark.parametrize('targets, expected', [
+    (['vim', 'palette'], ['vim-compiled', 'palette']),
+    (['vim-compiled'], ['vim-compiled']),
+])
+def test_parse_args_compiles_vim_target_only(targets, expected):
+    argv = ['a.itermcolors', '--compiled']
+    for target in targets:
+        argv.extend(['-t', target])
+    assert parse_args(argv).targets == expected
+
+def test_batch_convert_reports_duplicate_output_paths(tmp_path):
+    for directory in ['a', 'b', 'c']:
+        (tmp_path / directory).mkdir()
+    shutil.copy(THEME_PATH, tmp_path / 'a' / 'Theme.itermcolors')
+    shutil.copy(THEME_PATH, tmp_path / 'b' / 'Theme.itermcolors')
+    shutil.copy(THEME_PATH, tmp_path / 'c' / 'Other.itermcolors')
+
+    results = batch_convert([str(tmp_path / '*' / '*.itermcolors')], str(tmp_path / 'out'), jobs=1,
+                            use_cache=False)
+    errors = {os.path.basename(os.path.dirname(path)): error for path, _, _, error in results}
+    assert errors['c'] is None
+    assert 'would also be written by' in errors['a']
+    assert 'would also be written by' in errors['b']
+    assert os.listdir(tmp_path / 'out') == ['other.vim']
+
+@pytest.mark.parametrize('value', ['#abcd', '#11223344', '#gg0000', 'abcdef', '', None])
+def test_palette_from_dict_rejects_invalid_colors(value):
+    with pytest.raises(ValueError):
+        Palette.from_dict({'a': value, 'b': '#112233'})
+
+def test_palette_from_dict_keeps_valid_colors():
+    palette = Palette.from_dict({'a': '#AbCdEf', 'b': '#112233', 'c': 'NONE'})
+    assert palette.to_dict() == {'a': '#abcdef', 'b': '#112233', 'c': 'NONE'}
+
+@pytest.mark.parametrize('rgb', [(1, 2), (1, 2, 3, 4), (1, 2, 256)])
+def test_palette_set_rgb_rejects_invalid_colors(rgb):
+    palette = Palette.from_dict({'a': '#112233', 'b': '#445566'})
+    with pytest.raises(ValueError):
+        palette.set_rgb('a', rgb)
+    with pytest.raises(ValueError):
+        palette.set_rgb('c', rgb)
+    assert palette.to_dict() == {'a': '#112233', 'b': '#445566'}
+
+@pytest.fixture(scope='module')
+def lut_cache_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('lut'))
+
+@pytest.mark.parametrize('direction', ['p3_to_srgb', 'srgb_to_p3'])
+def test_lut_matches_direct_conversion_for_8bit_codes(direction, lut_cache_dir):
+    np = pytest.importorskip('numpy')
+    codes = np.random.default_rng(0).integers(0, 256, (2000, 3))
+    for colors in [codes, codes / 255]:
+        looked_up = lut_convert_colors(colors, direction, bits=8, dtype='float64', cache_dir=lut_cache_dir)
+        assert [to_hex(*color) for color in looked_up.tolist()] == \
+            [to_hex(*convert_color(color, direction)) for color in (codes / 255).tolist()]
+
+@pytest.mark.parametrize('direction', ['p3_to_srgb', 'srgb_to_p3'])
+def test_lut_interpolates_float_colors(direction, lut_cache_dir):
+    np = pytest.importorskip('numpy')
+    colors = np.random.default_rng(0).random((20000, 3))
+    looked_up = lut_convert_colors(colors, direction, bits=8, dtype='float64', cache_dir=lut_cache_dir)
+    error = np.abs(looked_up - convert_colors(colors, direction, dtype='float64')) * 255
+    assert np.percentile(error, 99) < 0.1
+    assert error.max() < 3.5
+
+def test_lut_rejects_out_of_range_codes(lut_cache_dir):
+    np = pytest.importorskip('numpy')
+    with pytest.raises(ValueError):
+        lut_convert_colors(np.array([[0, 0, 256]]), bits=8, cache_dir=lut_cache_dir)
+
+def test_contrast_report_skips_groups_with_missing_colors(colors):
+    palette = colors.to_dict()
+    del palette['fg']
+    report = get_contrast_report(palette, use_cache=False)
+    assert report['groups']
+    assert all('fg' not in (group['fg'], group['bg']) for group in report['groups'])
+
+def make_iterm_colors(seed):
+    """Return a random iTerm2 colors plist with colors in both color spaces and unrelated entries."""
+    rng = random.Random(seed)
+    entries = {}
+    for key in rng.sample(list(ITERM_TO_VIM_MAP), len(ITERM_TO_VIM_MAP) - 2):
+        entries[key] = {
+            'Red Component': rng.random(),
+            'Green Component': rng.random(),
+            'Blue Component': rng.random(),
+            'Alpha Component': 1.0,
+            'Color Space': rng.choice(['P3', 'sRGB']),
+        }
+    entries['Link Color'] = {'Red Component': 0.5, 'Green Component': 0.5, 'Blue Component': 0.5}
+    entries['Name'] = 'Random'
+    entries['Tags'] = ['a', {'Red Component': 1.0}]
+    items = list(entries.items())
+    rng.shuffle(items)
+    return plistlib.dumps(dict(items), sort_keys=False)
+
+def get_expected_base_colors(data):
+    """Read base colors with plistlib, independently of the converter's parsers."""
+    expected = {}
+    for key, value in plistlib.loads(data).items():
+        if key in ITERM_TO_VIM_MAP:
+            rgb = tuple(value.get(f'{channel} Component', 0) for channel in ('Red', 'Green', 'Blue'))
+            if value.get('Color Space') == 'P3':
+                rgb = convert_color(rgb)
+            expected[ITERM_TO_VIM_MAP[key]] = '#' + bytes(to_rgb8(*rgb)).hex()
+    return expected
+
+@pytest.mark.parametrize('seed', range(20))
+def test_stream_parse_matches_tree_parse(seed, tmp_path):
+    path = tmp_path / 'random.itermcolors'
+    data = make_iterm_colors(seed)
+    path.write_bytes(data)
+    expected = get_expected_base_colors(data)
+    assert list(parse_base_colors(str(path)).items()) == list(expected.items())
+    assert list(parse_base_colors(str(path), stream=True).items()) == list(expected.items())
+    assert list(parse_iterm_colors(str(path), stream=True).items()) == list(parse_iterm_colors(str(path)).items())
+
+def test_stream_parse_matches_tree_parse_for_theme():
+    with open(THEME_PATH, 'rb') as f:
+        expected = get_expected_base_colors(f.read())
+    assert list(parse_base_colors(THEME_PATH, stream=True).items()) == list(expected.items())
+    assert list(parse_iterm_colors(THEME_PATH, stream=True).items()) == list(parse_iterm_colors(THEME_PATH).items())
+
+@pytest.mark.parametrize('derived_colors, message', [
+    ({'a': ('b', 0.5), 'b': ('a', 0.5)}, 'cycle'),
+    ({'a': ('a', 0.5)}, 'cycle'),
+    ({'a': ('missing', 0.5)}, 'unknown base'),
+    ({'none': ('NONE', None), 'a': ('none', 0.5)}, 'NONE'),
+    ({'a': ('bg', 0.5, 0.5)}, 'must be'),
+])
+def test_compile_derived_colors_rejects_invalid_tables(derived_colors, message):
+    with pytest.raises(ValueError, match=message):
+        compile_derived_colors(derived_colors, ['bg'])
+
+def derive_colors_reference(colors):
+    """Derive colors one at a time with per-channel int() truncation."""
+    derived = {}
+    def resolve(name):
+        if name in colors:
+            return colors[name]
+        if name not in derived:
+            base, *factors = DERIVED_COLORS[name]
+            if base.startswith('#') or base == 'NONE':
+                derived[name] = base
+            else:
+                factors = [1.0] * 3 if factors == [None] else factors * 3 if len(factors) == 1 else factors
+                rgb = bytes.fromhex(resolve(base)[1:])
+                derived[name] = '#' + bytes(int(min(255.0, max(0.0, value * factor)))
+                                            for value, factor in zip(rgb, factors)).hex()
+        return derived[name]
+    return {name: resolve(name) for name in DERIVED_COLORS}
+
+@pytest.mark.parametrize('seed', range(200))
+def test_derive_colors_matches_reference(seed):
+    rng = random.Random(seed)
+    colors = {name: f'#{rng.randrange(1 << 24):06x}' for name in ITERM_TO_VIM_MAP.values()}
+    assert derive_colors(colors) == derive_colors_reference(colors)
+
+def test_update_palette_matches_full_rebuild():
+    rng = random.Random(0)
+    base_names = list(dict.fromkeys(ITERM_TO_VIM_MAP.values()))
+    for _ in range(2000):
+        old = {name: f'#{rng.randrange(1 << 24):06x}' for name in base_names if rng.random() < 0.97}
+        new = dict(old)
+        for name in rng.sample(list(new), rng.randint(0, 4)):
+            new[name] = f'#{rng.randrange(1 << 24):06x}'
+        if rng.random() < 0.1:
+            new.pop(rng.choice(list(new)))
+
+        palette = build_palette(old)
+        updated, changed = update_palette(palette, Palette.from_dict(new))
+        rebuilt = build_palette(new)
+        assert list(updated.items()) == list(rebuilt.items())
+        assert changed == {name for name in palette.keys() | rebuilt.keys() if palette.get(name) != rebuilt.get(name)}
+        # The previous palette is left as it was
+        assert list(palette.items()) == list(build_palette(old).items())
+
+def get_rows(palette):
+    """Return the names of each palette row, to compare which colors share rows."""
+    rows = {}
+    for name in palette:
+        rows.setdefault(palette.row(name), []).append(name)
+    return sorted(rows.values())
+
+@pytest.mark.parametrize('palette', [
+    Palette(),
+    Palette.from_dict({'none': 'NONE'}),
+    Palette.from_dict({'a': '#112233', 'b': '#112233', 'c': 'NONE', 'é': '#abcdef'}, {'b': 'a'}),
+], ids=['empty', 'none', 'aliases'])
+def test_palette_bytes_round_trip(palette):
+    loaded = Palette.from_buffer(palette.to_bytes())
+    assert list(loaded.items()) == list(palette.items())
+    assert get_rows(loaded) == get_rows(palette)
+
+def test_palette_bytes_round_trip_for_theme(colors):
+    loaded = Palette.from_buffer(memoryview(colors.to_bytes()))
+    assert list(loaded.items()) == list(colors.items())
+    assert loaded.get_aliases() == colors.get_aliases()
+
+def test_palette_from_buffer_rejects_invalid_data(colors):
+    data = colors.to_bytes()
+    with pytest.raises(ValueError, match='too short'):
+        Palette.from_buffer(data[:PALETTE_HEADER.size - 1])
+    with pytest.raises(ValueError, match='truncated'):
+        Palette.from_buffer(data[:-1])
+    with pytest.raises(ValueError, match='Not a palette file'):
+        Palette.from_buffer(b'XXXX' + data[4:])
+    with pytest.raises(ValueError, match='version'):
+        Palette.from_buffer(data[:4] + b'\xff\xff' + data[6:])
+
+@pytest.mark.parametrize('target', ['palette', 'palette-json'])
+def test_palette_files_round_trip(target, colors, tmp_path):
+    _, get_file_name, render = RENDERERS[target]
+    path = tmp_path / get_file_name(THEME_NAME)
+    chunks = list(render(colors, THEME_NAME))
+    path.write_bytes(b''.join(chunks) if isinstance(chunks[0], bytes) else ''.join(chunks).encode())
+    loaded = read_palette_file(str(path))
+    assert list(loaded.items()) == list(colors.items())
+    assert loaded.get_aliases() == colors.get_aliases()
+    if target == 'palette':
+        np = pytest.importorskip('numpy')
+        assert np.array_equal(load_palette_array(str(path)), np.asarray(colors.view()))
+
+def test_read_palette_file_rejects_other_files(tmp_path):
+    path = tmp_path / 'empty.sqpalette'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        read_palette_file(str(path))
+    path.write_bytes(b'not a palette file')
+    with pytest.raises(ValueError):
+        read_palette_file(str(path))
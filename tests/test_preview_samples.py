@@ -0,0 +1,33 @@
+"""Tests for preview_samples.py."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preview_samples import get_token_cache_key, tokenize_samples  # noqa: E402
+
+pytest.importorskip('pygments')
+
+def test_token_cache_key_depends_on_lexer():
+    data = b'project(example)\n'
+    assert get_token_cache_key('CMakeLists.txt', data) != get_token_cache_key('notes.txt', data)
+    assert get_token_cache_key('a/notes.txt', data) == get_token_cache_key('b/readme.txt', data)
+
+def test_token_cache_is_size_limited(tmp_path, monkeypatch):
+    monkeypatch.setenv('SQUIRRELSONG_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr('preview_samples.TOKEN_CACHE_MAX_BYTES', 1000)
+    paths = []
+    for index in range(20):
+        path = tmp_path / f'sample{index}.py'
+        path.write_text(f'value = {index}\n' * 20)
+        paths.append(str(path))
+
+    samples, tokenized = tokenize_samples(paths, jobs=1)
+    assert tokenized == len(paths)
+    cache_dir = tmp_path / 'cache' / 'tokens'
+    assert sum(entry.stat().st_size for entry in os.scandir(cache_dir)) <= 1000
+
+    # Evicted samples are tokenized again, with the same result
+    assert tokenize_samples(paths, jobs=1)[0] == samples
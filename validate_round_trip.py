@@ -0,0 +1,150 @@
+"""Validate sRGB -> P3 -> sRGB round trips of the converter over the whole 8-bit sRGB cube.
+
+Usage: python validate_round_trip.py [--dtype float32|float64] [--jobs N] [--max-error STEPS] [--json FILE]
+
+Every one of the 16.7M 8-bit sRGB colors is converted to P3 and back with
+convert_colors(), in chunks of whole red planes spread over a process pool.
+Errors are reported in 8-bit steps, along with how many colors don't come
+back as the same 8-bit code, both with the truncation to_hex() uses and
+with rounding. With --max-error it exits with status 1 when the largest
+error goes over the limit, so it can guard changes to the conversion
+matrices.
+
+Conversions clip to [0, 1], so colors that land outside the other gamut
+come back clipped, which shows up as errors far above quantization.
+"""
+import argparse
+import heapq
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from convert_iterm2_to_vim import convert_colors
+
+# Red planes per chunk, a chunk of 8 planes holds 512K colors
+CHUNK_PLANES = 8
+
+# Number of worst round trips to report
+WORST_COUNT = 10
+
+def validate_chunk(job):
+    """Round trip every color with red values in [start, stop) and return the chunk's statistics."""
+    start, stop, dtype, worst_count = job
+    levels = np.arange(256, dtype=np.uint8)
+    codes = np.empty(((stop - start) * 65536, 3), dtype=np.uint8)
+    codes[:, 0] = np.repeat(np.arange(start, stop, dtype=np.uint8), 65536)
+    codes[:, 1] = np.tile(np.repeat(levels, 256), stop - start)
+    codes[:, 2] = np.tile(levels, (stop - start) * 256)
+
+    srgb = codes.astype(dtype) / np.dtype(dtype).type(255)
+    p3 = convert_colors(srgb, 'srgb_to_p3', dtype=dtype)
+    round_trip = convert_colors(p3, 'p3_to_srgb', dtype=dtype)
+
+    # Largest channel error of each color, in 8-bit steps
+    errors = (np.abs(round_trip.astype(np.float64) - srgb) * 255).max(axis=1)
+
+    # Same quantization as to_hex(), and plain rounding
+    truncated = (round_trip * 255).astype(np.int64)
+    rounded = np.rint(round_trip * 255).astype(np.int64)
+
+    worst = np.argsort(errors)[-worst_count:]
+    return {
+        'count': len(codes),
+        'error_sum': float(errors.sum()),
+        'max_error': float(errors.max()),
+        'truncated_mismatches': int((truncated != codes).any(axis=1).sum()),
+        'rounded_mismatches': int((rounded != codes).any(axis=1).sum()),
+        'worst': [
+            (float(errors[i]), codes[i].tolist(), p3[i].tolist(), round_trip[i].tolist())
+            for i in worst
+        ],
+    }
+
+def validate_round_trip(dtype='float64', jobs=None, worst_count=WORST_COUNT):
+    """Round trip the whole 8-bit sRGB cube through P3 and return combined statistics.
+
+    Args:
+        dtype: Floating point type used for the math, float32 or float64
+        jobs: Number of worker processes, defaults to the number of CPUs
+        worst_count: Number of worst round trips to keep
+
+    Returns:
+        Dict with the number of colors, mean and max error in 8-bit steps,
+        numbers of colors that don't come back as the same 8-bit code with
+        truncation and rounding, and the worst round trips as (error, 8-bit
+        sRGB, P3, round-tripped sRGB) tuples
+    """
+    job_list = [(start, min(start + CHUNK_PLANES, 256), np.dtype(dtype).name, worst_count)
+                for start in range(0, 256, CHUNK_PLANES)]
+    if jobs == 1:
+        chunks = [validate_chunk(job) for job in job_list]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunks = list(executor.map(validate_chunk, job_list))
+
+    count = sum(chunk['count'] for chunk in chunks)
+    return {
+        'dtype': np.dtype(dtype).name,
+        'count': count,
+        'mean_error': sum(chunk['error_sum'] for chunk in chunks) / count,
+        'max_error': max(chunk['max_error'] for chunk in chunks),
+        'truncated_mismatches': sum(chunk['truncated_mismatches'] for chunk in chunks),
+        'rounded_mismatches': sum(chunk['rounded_mismatches'] for chunk in chunks),
+        'worst': heapq.nlargest(worst_count, (worst for chunk in chunks for worst in chunk['worst']),
+                                key=lambda worst: worst[0]),
+    }
+
+def format_rgb(values):
+    """Format float RGB values for the report."""
+    return '(' + ', '.join(f'{value:.9f}' for value in values) + ')'
+
+def print_report(results, elapsed):
+    """Print the round trip statistics."""
+    count = results['count']
+    print(f"Round-tripped {count:,} colors sRGB -> P3 -> sRGB in {results['dtype']} in {elapsed:.2f}s\n")
+    print(f"max error:   {results['max_error']:.3g} steps of 255")
+    print(f"mean error:  {results['mean_error']:.3g} steps of 255")
+    for name, label in [('truncated_mismatches', 'truncated (like to_hex)'), ('rounded_mismatches', 'rounded')]:
+        print(f"changed 8-bit codes, {label + ':':<24} {results[name]:>10,} ({results[name] / count:.2%})")
+
+    print(f"\nWorst {len(results['worst'])} round trips:")
+    for error, codes, p3, round_trip in results['worst']:
+        print(f"  #{bytes(codes).hex()}  error {error:.3g}  P3 {format_rgb(p3)}  back {format_rgb(round_trip)}")
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Validate sRGB -> P3 -> sRGB round trips over the 8-bit sRGB cube.")
+    parser.add_argument('--dtype', choices=('float32', 'float64'), default='float64',
+                        help="floating point type used for the math (default: float64)")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--max-error', type=float, metavar='STEPS',
+                        help="fail if any error is over this many 8-bit steps, 0.5 is the most that still "
+                             "rounds back to the same code")
+    parser.add_argument('--json', metavar='FILE', help="also save the results to a JSON file")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    start = time.perf_counter()
+    results = validate_round_trip(args.dtype, args.jobs)
+    print_report(results, time.perf_counter() - start)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        print(f"\nResults saved to '{args.json}'")
+
+    if args.max_error is not None and results['max_error'] > args.max_error:
+        print(f"\nError: max error is over {args.max_error} steps", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()